@@ -2,17 +2,24 @@ import json
 
 import os
 import sys
+import hashlib
 import logging
 
 import requests
 from urllib.parse import quote
 
-import spotipy
-import utils
+import artifacts
+import cache
+import genre_table
+import http_client
+import umbrella
 
 import subprocess
 from glob import glob
-import time
+from concurrent.futures import ThreadPoolExecutor
+
+# utils and library (and with them numpy and spotipy) are imported by the functions that use
+# them, so that importing this module for e.g. is_cached stays cheap
 
 # Spotify URLS
 SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
@@ -27,36 +34,92 @@ recently_played_endpoint = "{}/player/recently-played".format(user_profile_api_e
 top_tracks_endpoint = "{}/top/tracks".format(user_profile_api_endpoint)
 top_artists_endpoint = "{}/top/artists".format(user_profile_api_endpoint)
 
-def get(endpoint, token, max_retries=10, delay=4):
+# Scraped user data is cached as JSON files under DATA_FOLDER/<user_id>
+DATA_FOLDER = "/tmp/data"
+CACHE_FILES = [
+    "profile.json",
+    "playlists.json",
+    "library.json",
+    "top_artists.json",
+    "top_tracks.json",
+    "recently_played.json",
+]
+
+def get_user_folder(user_id):
+    return os.path.join(DATA_FOLDER, user_id)
+
+# True if every section of this user's data has already been scraped
+def is_cached(user_id):
+    user_folder = get_user_folder(user_id)
+    return all(os.path.exists(os.path.join(user_folder, file_name)) for file_name in CACHE_FILES)
+
+# Log a scrape stage and pass it on to the caller's progress callback, if any
+def report_progress(progress, message):
+    logging.info(message)
+    if progress:
+        progress(message)
+
+# Builds a columnar Library of tracks from what we know about each of them
+# tracks are Spotify track objects wrapped as { 'track' : ... }
+# track_features maps a track's uri to its feature values (ordered as feature_names),
+# tracks that have no features are left out
+# artist_names, genres and (optionally) dates have an entry per track
+def build_tracks_library(tracks, track_features, feature_names, artist_names, genres, dates=None):
+    from library import Library
+    keep = [i for i, track in enumerate(tracks) if str(track['track']['uri']) in track_features]
+    uris = [str(tracks[i]['track']['uri']) for i in keep]
+
+    columns = {
+        'name' : [tracks[i]['track']['name'] for i in keep],
+        'uri' : uris,
+    }
+    if dates is not None:
+        columns['date'] = [dates[i] for i in keep]
+    columns['genres'] = [genres[i] for i in keep]
+    columns['artists'] = [artist_names[i] for i in keep]
+    for j, feature_name in enumerate(feature_names):
+        columns[feature_name] = [track_features[uri][j] for uri in uris]
+
+    return Library.from_columns(columns)
+
+# Map track uri -> features from the output of utils.featurize_tracks
+def get_track_features(track_uris, data):
+    return { track_uri : features for track_uri, features in zip(track_uris, data['features']) }
+
+# Rate limiting and retries are handled by http_client, so anything but OK here is an error
+def get(endpoint, token):
     authorization_header = {"Authorization": "Bearer {}".format(token)}
     try:
         logging.info("GET: " + endpoint)
         print("GET: " + endpoint)
-        response = requests.get(endpoint, headers=authorization_header)
-    except requests.exceptions.ConnectionError as e:
-        response = {}
-        response.status_code = 429
-        logging.warn("Could not fulfill GET.\n" + e)
+        response = http_client.get(endpoint, headers=authorization_header)
+    except requests.exceptions.RequestException as e:
+        msg = "Could not fulfill GET {}: {}".format(endpoint, e)
+        logging.error(msg)
+        raise RuntimeError(msg)
     # If status is anything but OK, raise an error
     if response.status_code != 200:
-        if response.status_code == 429:
-            if max_retries > 0:
-                # print("Hit rate limit! Sleeping for {} seconds before retrying...".format(delay))
-                time.sleep(delay)
-                return get(endpoint, token, max_retries=max_retries - 1, delay=delay + 1)
-            else:
-                msg = "Connection refused after {} retries".format(max_retries)
-                logging.error(msg)
-                raise RuntimeError(msg)
         logging.error(response.reason)
         raise RuntimeError(response.reason)
     
-    return response	
+    return response
 
+# Identifies an access token in caches and sessions without storing the token itself
+def get_token_key(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+# The profile of the user the token belongs to, cached for as long as the token is valid
 def get_profile_data(token):
+    profile_cache = cache.get_profile_cache()
+    token_key = get_token_key(token)
+    profile_data = profile_cache.get(token_key)
+    if profile_data is not None:
+        return profile_data
+
     user_profile_api_endpoint = "{}/me".format(SPOTIFY_API_URL)
     profile_response = get(user_profile_api_endpoint, token)
     profile_data = profile_response.json()
+    profile_cache.put(token_key, profile_data)
 
     return profile_data
 
@@ -81,52 +144,159 @@ def get_user_playlists(token, user_id):
 
     return playlists
 
-def scrape_library(token, spotipy_session, user_id, limit=50):
-    # print("Scraping library of {}".format(user_id))
-    assert(limit <= 50)
-
-    # Scrape entire library
+# Yields the pages of a user's saved tracks one at a time as they are downloaded, newest first
+# If info is given, it is filled with the library's total number of tracks and the items
+# of the first (newest) page
+def get_library_pages(token, limit=50, info=None):
     library_data = get(user_tracks_endpoint + "?limit={}".format(limit), token).json()
-    all_library_data = []
-    all_library_data.append(library_data)    
+    if info is not None:
+        info['total'] = library_data['total']
+        info['newest'] = library_data['items']
+    yield library_data
     while library_data['next']:
-        # print(library_data['next'])
         library_data = get(library_data['next'], token).json()
-        all_library_data.append(library_data)
-        
-    # Aggregate all results
-    user_tracks = sum([data['items'] for data in all_library_data], [])
-
-    # Get information about each track
-    # print("Featurizing tracks")
-    track_names, track_uris, data = utils.featurize_tracks(user_tracks, spotipy_session, verbose=True)
-    # print("Getting song genres")
-    artist_names, artist_uris, genres = utils.get_song_genres(user_tracks, spotipy_session, verbose=True)
+        yield library_data
+
+# Scrapes the audio features and genres of every track in an iterable of pages of saved tracks
+# This is a pipeline: as each page of tracks arrives, its artists' genres are requested and
+# every full batch of feature_batch_size tracks is featurized on a pool of max_workers threads,
+# while the next page downloads. Wall clock time is then close to that of the slowest stage
+# rather than the sum of all three
+def scrape_tracks(pages, spotipy_session, progress=None, max_workers=4, feature_batch_size=100):
+    import utils
+    user_tracks = []
+    genre_futures = []
+    feature_futures = []
+    num_featurized = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for library_data in pages:
+            page_tracks = library_data['items']
+            user_tracks += page_tracks
+            genre_futures.append(executor.submit(utils.get_song_genres, page_tracks, spotipy_session, verbose=True))
+
+            while len(user_tracks) - num_featurized >= feature_batch_size:
+                batch = user_tracks[num_featurized:num_featurized + feature_batch_size]
+                feature_futures.append(executor.submit(utils.featurize_tracks, batch, spotipy_session, verbose=True))
+                num_featurized += len(batch)
+
+        # Featurize the last partial batch
+        if num_featurized < len(user_tracks):
+            batch = user_tracks[num_featurized:]
+            feature_futures.append(executor.submit(utils.featurize_tracks, batch, spotipy_session, verbose=True))
+
+        # Get information about each track as it finishes
+        # print("Featurizing tracks")
+        report_progress(progress, "Scraping song features")
+        track_features = {}
+        feature_names = []
+        for future in feature_futures:
+            track_names, track_uris, data = future.result()
+            feature_names = data['feature_names']
+            track_features.update(get_track_features(track_uris, data))
+
+        # print("Getting song genres")
+        report_progress(progress, "Scraping artist genres")
+        artist_names = []
+        genres = []
+        for future in genre_futures:
+            page_artist_names, page_artist_uris, page_genres = future.result()
+            artist_names += page_artist_names
+            genres += page_genres
+
     dates = utils.get_dates_added(user_tracks)
 
-    # Aggregate tracks into a single JSON object
-    user_library_data = []
-    num_tracks = len(user_tracks)
-    for i in range(num_tracks):
-        track_name = track_names[i]
-        date_added = dates[i]
-        track_uri = track_uris[i]
-        track_features = data['features'][i]
-        track_genres = genres[i]
-        track_artists = artist_names[i]
-        user_library_data.append(
-            { 
-                'name' : track_name,
-                'uri' : track_uri,
-                'date' : date_added,
-                'genres' : track_genres, 
-                'artists' : track_artists,
-            }
-        )
-        for feature, feature_name in zip(track_features, data['feature_names']):
-            user_library_data[-1][feature_name] = feature
-
-    return user_library_data
+    # Aggregate tracks into a single columnar library
+    return build_tracks_library(user_tracks, track_features, feature_names, artist_names, genres, dates=dates)
+
+def scrape_library(token, spotipy_session, user_id, limit=50, progress=None, max_workers=4, feature_batch_size=100, info=None):
+    # print("Scraping library of {}".format(user_id))
+    assert(limit <= 50)
+
+    # Scrape entire library
+    report_progress(progress, "Scraping library")
+    pages = get_library_pages(token, limit=limit, info=info)
+    return scrape_tracks(pages, spotipy_session, progress=progress, max_workers=max_workers,
+                         feature_batch_size=feature_batch_size)
+
+# What we need to remember about a scraped library to refresh it incrementally later:
+# its total number of tracks and the newest added_at time seen (the watermark), along with
+# the uris added at exactly that time since added_at only has a resolution of a second
+def get_library_meta(total, newest_tracks):
+    if len(newest_tracks) == 0:
+        return { "total" : total, "watermark" : None, "watermark_uris" : [] }
+
+    watermark = max(track['added_at'] for track in newest_tracks)
+    return {
+        "total" : total,
+        "watermark" : watermark,
+        "watermark_uris" : [str(track['track']['uri']) for track in newest_tracks if track['added_at'] == watermark],
+    }
+
+# Brings a previously scraped library up to date
+# /v1/me/tracks lists tracks newest first, so pages are only fetched until they reach the
+# watermark and only the tracks added since are featurized and genre tagged
+# Returns the updated library and its meta data, or None if tracks have been removed from the
+# library (detected by the total not adding up), in which case it needs to be scraped again
+def refresh_library(token, spotipy_session, user_id, library, meta, limit=50, progress=None):
+    from library import Library
+    report_progress(progress, "Refreshing library")
+    info = {}
+    new_tracks = []
+    watermark_uris = set(meta['watermark_uris'])
+    for library_data in get_library_pages(token, limit=limit, info=info):
+        reached_watermark = False
+        for track in library_data['items']:
+            if meta['watermark'] is not None and (track['added_at'] < meta['watermark'] or 
+               (track['added_at'] == meta['watermark'] and str(track['track']['uri']) in watermark_uris)):
+                reached_watermark = True
+                break
+            new_tracks.append(track)
+        if reached_watermark:
+            break
+
+    if info['total'] != meta['total'] + len(new_tracks):
+        logging.info("Library of {} has had tracks removed.".format(user_id))
+        return None
+
+    if len(new_tracks) == 0:
+        return library, meta
+
+    logging.info("Adding {} new tracks to the library of {}.".format(len(new_tracks), user_id))
+    new_library = scrape_tracks([{ 'items' : new_tracks }], spotipy_session, progress=progress)
+    library = Library.from_records(new_library.to_records() + library.to_records())
+    new_meta = get_library_meta(info['total'], new_tracks)
+    # tracks added in the same second as the old watermark
+    if new_meta['watermark'] == meta['watermark']:
+        new_meta['watermark_uris'] += meta['watermark_uris']
+
+    return library, new_meta
+
+# Returns the user's library, scraping it if it isn't cached
+# With refresh, a cached library is brought up to date with refresh_library instead,
+# falling back on scraping it again if that isn't possible
+def scrape_library_cached(token, spotipy_session, user_id, library_file, meta_file, refresh=False, progress=None):
+    from library import Library
+    if os.path.exists(library_file):
+        library = Library.from_records(read_json(library_file))
+        if not refresh:
+            return library
+
+        if os.path.exists(meta_file):
+            refreshed = refresh_library(token, spotipy_session, user_id, library, read_json(meta_file), progress=progress)
+            if refreshed is not None:
+                library, meta = refreshed
+                write_json(library_file, library)
+                write_json(meta_file, meta)
+                return library
+
+    info = {}
+    library = scrape_library(token, spotipy_session, user_id, progress=progress, info=info)
+    # write the library before its meta data, so the meta data never describes newer tracks
+    # than the library holds
+    write_json(library_file, library)
+    write_json(meta_file, get_library_meta(info['total'], info['newest']))
+
+    return library
 
 def scrape_top_artists(token, spotipy_session, user_id, limit=50):
     assert(limit <= 50)
@@ -163,6 +333,7 @@ def scrape_top_artists(token, spotipy_session, user_id, limit=50):
     return top_artists_data_all
 
 def scrape_top_songs(token, spotipy_session, user_id, limit=50):
+    import utils
     assert(limit <= 50)
 
     top_tracks_data_all = {}
@@ -176,34 +347,19 @@ def scrape_top_songs(token, spotipy_session, user_id, limit=50):
 
         top_tracks = response.json()
         
-        track_names, track_uris, data = utils.featurize_tracks([{ 'track' : track } for track in top_tracks['items']], spotipy_session, verbose=True)
-        artist_names, artist_uris, genres = utils.get_song_genres([{ 'track' : track } for track in top_tracks['items']], spotipy_session, verbose=True)
-
-        top_tracks_data = []
-
-        num_tracks = len(top_tracks['items'])
-        for i in range(num_tracks):
-            track_name = track_names[i]
-            track_uri = track_uris[i]
-            track_features = data['features'][i]
-            track_genres = genres[i]
-            track_artists = artist_names[i]
-            top_tracks_data.append(
-                { 
-                    'name' : track_name,
-                    'uri' : track_uri,
-                    'genres' : track_genres, 
-                    'artists' : track_artists,
-                }
-            )
-            for feature, feature_name in zip(track_features, data['feature_names']):
-                top_tracks_data[-1][feature_name] = feature
+        tracks = [{ 'track' : track } for track in top_tracks['items']]
+        track_names, track_uris, data = utils.featurize_tracks(tracks, spotipy_session, verbose=True)
+        artist_names, artist_uris, genres = utils.get_song_genres(tracks, spotipy_session, verbose=True)
+
+        top_tracks_data = build_tracks_library(tracks, get_track_features(track_uris, data), data['feature_names'],
+                                               artist_names, genres)
         
         top_tracks_data_all[time_range] = top_tracks_data
        
     return top_tracks_data_all
 
 def scrape_recently_played(token, spotipy_session, user_id, limit=50):
+    import utils
     assert(limit <= 50)
 
     response = get(recently_played_endpoint + "?limit={}".format(limit), token)
@@ -215,42 +371,85 @@ def scrape_recently_played(token, spotipy_session, user_id, limit=50):
 
     dates = [track['played_at'] for track in recently_played['items']]
 
-    recently_played_data = []
-    num_tracks = len(recently_played['items'])
-    for i in range(num_tracks):
-        track_name = track_names[i]
-        date_added = dates[i]
-        track_uri = track_uris[i]
-        track_features = data['features'][i]
-        track_genres = genres[i]
-        track_artists = artist_names[i]
-        recently_played_data.append(
-            { 
-                'name' : track_name,
-                'uri' : track_uri,
-                'date' : date_added,
-                'genres' : track_genres, 
-                'artists' : track_artists,
-            }
-        )
-        for feature, feature_name in zip(track_features, data['feature_names']):
-            recently_played_data[-1][feature_name] = feature
-    
-    return recently_played_data
+    return build_tracks_library(recently_played['items'], get_track_features(track_uris, data), data['feature_names'],
+                                artist_names, genres, dates=dates)
+
+# Libraries are written in the list of track dictionaries format the front end reads
+def encode_json(data):
+    from library import Library
+    if isinstance(data, Library):
+        return data.to_records()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(data).__name__))
 
+# Writes compact JSON plus precompressed copies for /data to serve
 def write_json(file_name, data):
     logging.info("Writing song data to {}.".format(file_name))
-    open(file_name, "w").write(json.dumps(data, indent=4))
+    artifacts.write_json(file_name, data, default=encode_json)
 
 def read_json(file_name):
     logging.info("Reading cached data from {}.".format(file_name))
     return json.loads(open(file_name, "r").read())
 
-def scrape_data(token, spotipy_session, user_id):
+# Reads a user's scraped library, None if it hasn't been scraped yet
+def read_library(user_id):
+    from library import Library
+    library_file = os.path.join(get_user_folder(user_id), "library.json")
+    if not os.path.exists(library_file):
+        return None
+
+    return Library.from_records(read_json(library_file))
+
+def get_library_umbrellas_file(user_id):
+    return os.path.join(get_user_folder(user_id), "library_umbrellas.json")
+
+# True if the user's library has been scraped but its umbrella genres (see umbrella.py) are
+# missing or older than the library or the genre table, e.g. for a library scraped before
+# they were written
+def needs_library_umbrellas(user_id):
+    library_file = os.path.join(get_user_folder(user_id), "library.json")
+    try:
+        modified = max(os.path.getmtime(library_file), os.path.getmtime(genre_table.NAMES_FILE))
+    except OSError:
+        return False
+    try:
+        return os.path.getmtime(get_library_umbrellas_file(user_id)) < modified
+    except OSError:
+        return True
+
+# Writes the umbrella genres of a user's library and its timeline next to library.json, unless
+# they are already up to date
+# library is the user's Library if the caller has it at hand, otherwise it is read from disk
+# Returns the file's name, or None if the user's library hasn't been scraped yet
+def ensure_library_umbrellas(user_id, library=None):
+    umbrellas_file = get_library_umbrellas_file(user_id)
+    if not needs_library_umbrellas(user_id):
+        return umbrellas_file if os.path.exists(umbrellas_file) else None
+
+    if library is None:
+        library = read_library(user_id)
+    # a user without saved tracks has a library without any columns
+    if len(library) == 0:
+        genres, dates = [], []
+    else:
+        genres = library.column("genres") if "genres" in library.keys() else [[]] * len(library)
+        dates = library.column("date") if "date" in library.keys() else [None] * len(library)
+    umbrellas = umbrella.get_library_umbrellas(genres, dates, genre_table.get_genre_table().names)
+    write_json(umbrellas_file, umbrellas)
+
+    return umbrellas_file
+
+# Scrapes (or reads from cache) every section of a user's data
+# Only the profile has to be known before the other sections can be scraped, so once it is
+# the remaining sections run concurrently on up to max_workers threads. Each section writes
+# its JSON cache file as soon as it finishes. max_workers=1 scrapes them one after another
+# progress is an optional callback that is passed a message as each library stage starts
+# With refresh, cached data is scraped again, except for the library which is only
+# updated with the tracks added since it was last scraped
+def scrape_data(token, spotipy_session, user_id, max_workers=4, progress=None, refresh=False):
+    from library import Library
     # Output data to file
-    user_folder = os.path.join("/tmp/data", user_id)
-    if not os.path.exists(user_folder):
-        os.makedirs(user_folder)
+    user_folder = get_user_folder(user_id)
+    os.makedirs(user_folder, exist_ok=True)
     
     time_ranges = [
         "short_term", 
@@ -263,24 +462,52 @@ def scrape_data(token, spotipy_session, user_id):
     top_artists_file = os.path.join(user_folder, "top_artists.json")
     top_tracks_file = os.path.join(user_folder, "top_tracks.json")
     recently_played_file = os.path.join(user_folder, "recently_played.json")
+    library_meta_file = os.path.join(user_folder, "library_meta.json")
 
-    def scrape_if_not_cached(file_name, scraper, *args):
-        if not os.path.exists(file_name):
+    # load converts data read from the cache into what the scraper would have returned
+    def scrape_if_not_cached(file_name, scraper, *args, load=None):
+        if refresh or not os.path.exists(file_name):
             data = scraper(*args)
             write_json(file_name, data)
         else:
             data = read_json(file_name)
+            if load:
+                data = load(data)
         
         return data
 
+    def load_libraries(data):
+        return { time_range : Library.from_records(records) for time_range, records in data.items() }
+
     profile_data = scrape_if_not_cached(profile_file, get_profile_data, token)
     user_id = profile_data['id']
 
-    playlists_data = scrape_if_not_cached(playlists_file, get_user_playlists, token, user_id)
-    library_data = scrape_if_not_cached(library_file, scrape_library, token, spotipy_session, user_id)
-    recently_played = scrape_if_not_cached(recently_played_file, scrape_recently_played, token, spotipy_session, user_id)
-    top_artists = scrape_if_not_cached(top_artists_file, scrape_top_artists, token, spotipy_session, user_id)
-    top_songs = scrape_if_not_cached(top_tracks_file, scrape_top_songs, token, spotipy_session, user_id)
+    sections = {
+        "playlists" : (playlists_file, get_user_playlists, token, user_id),
+        "recently_played" : (recently_played_file, scrape_recently_played, token, spotipy_session, user_id),
+        "top_artists" : (top_artists_file, scrape_top_artists, token, spotipy_session, user_id),
+        "top_tracks" : (top_tracks_file, scrape_top_songs, token, spotipy_session, user_id),
+    }
+    loaders = {
+        "recently_played" : Library.from_records,
+        "top_tracks" : load_libraries,
+    }
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # The library is by far the slowest section, so start it first
+        futures = {
+            "library" : executor.submit(scrape_library_cached, token, spotipy_session, user_id, library_file,
+                                        library_meta_file, refresh=refresh, progress=progress)
+        }
+        for section, args in sections.items():
+            futures[section] = executor.submit(scrape_if_not_cached, *args, load=loaders.get(section))
+        # result() re-raises any exception from the scraper in this thread
+        results = { section : future.result() for section, future in futures.items() }
+
+    playlists_data = results["playlists"]
+    library_data = results["library"]
+    recently_played = results["recently_played"]
+    top_artists = results["top_artists"]
+    top_songs = results["top_tracks"]
 
     # Package everything into a dictionary for easy return
     ret_dict = {
@@ -0,0 +1,95 @@
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# JSON files served through /data
+# They are written compactly, together with precompressed copies next to them (e.g.
+# library.json.gz), so that /data can send a compressed copy to clients that accept one
+# without compressing anything per request
+# A hash of the content is also written next to each file (e.g. library.json.etag) and used
+# as its ETag, so that /data can answer conditional requests without reading the file
+
+# Every scrape and refresh writes these (library.json can be several MB), so the levels trade a
+# few percent of size for compressing many times faster than the maximum levels would
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Content-Encoding -> (file suffix, compress function), in order of preference
+# Brotli is optional: without the package, only gzip copies are written
+ENCODINGS = [("gzip", ".gz", lambda content: gzip.compress(content, compresslevel=GZIP_LEVEL, mtime=0))]
+if brotli is not None:
+    ENCODINGS.insert(0, ("br", ".br", lambda content: brotli.compress(content, mode=brotli.MODE_TEXT,
+                                                                      quality=BROTLI_QUALITY)))
+
+def dumps(data, default=None):
+    return json.dumps(data, separators=(",", ":"), default=default).encode("utf-8")
+
+# Writes content (bytes) to a temporary file next to file_name and renames it into place,
+# so readers (in any process) see either the old file or the new one, never half of one
+def write_atomic(file_name, content):
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(file_name) or ".",
+                                    prefix=os.path.basename(file_name) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_file, file_name)
+    except BaseException:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+
+# Writes content (bytes) to file_name and a compressed copy per encoding
+def write(file_name, content):
+    write_atomic(file_name, content)
+
+    for _, suffix, compress in ENCODINGS:
+        write_atomic(file_name + suffix, compress(content))
+
+    # written last, so an ETag never describes content that hasn't been written yet
+    write_atomic(file_name + ".etag", hashlib.sha256(content).hexdigest()[:32].encode("utf-8"))
+
+def write_json(file_name, data, default=None):
+    write(file_name, dumps(data, default=default))
+
+# Returns (encoding, suffix) of the best precompressed copy of file_name that the client accepts
+# accept_encodings is a werkzeug Accept object, e.g. request.accept_encodings
+# Returns (None, "") if the file should be sent as is
+def choose_encoding(file_name, accept_encodings):
+    try:
+        modified = os.path.getmtime(file_name)
+    except OSError:
+        return None, ""
+
+    for encoding, suffix, _ in ENCODINGS:
+        if accept_encodings[encoding] <= 0:
+            continue
+        try:
+            # a copy older than the file belongs to a previous version of it
+            if os.path.getmtime(file_name + suffix) >= modified:
+                return encoding, suffix
+        except OSError:
+            pass
+
+    return None, ""
+
+# Returns the ETag of file_name as sent with the given encoding, or None if it has none
+# Each encoding is a different representation of the file, so each gets its own ETag
+def get_etag(file_name, encoding=None):
+    try:
+        with open(file_name + ".etag", "r") as f:
+            etag = f.read().strip()
+    except OSError:
+        return None
+
+    if encoding:
+        etag = "{}-{}".format(etag, encoding)
+    return etag
@@ -1,13 +1,14 @@
 import os
 import sys
+import time
 import logging
+import threading
+from concurrent.futures import Future
 
-import requests
 from urllib.parse import quote
 import json
 
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+import http_client
 
 def get_id_and_secret():
     try:
@@ -47,7 +48,7 @@ def get_token(request, client_id, client_secret, callback_url):
             'client_id': client_id,
             'client_secret': client_secret,
         }
-        post_request = requests.post(SPOTIFY_TOKEN_URL, data=code_payload)
+        post_request = http_client.post(SPOTIFY_TOKEN_URL, data=code_payload)
     except Exception as e:
         logging.error("Failed to request token from Spotify.\n" + e)
 
@@ -59,11 +60,109 @@ def get_token(request, client_id, client_secret, callback_url):
 
     return access_token, refresh_token, token_type, expires_in
 
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+# App tokens are refreshed in the background once they are within this many seconds of expiring,
+# and requests keep using the current token meanwhile; an expired token is refreshed before use
+TOKEN_REFRESH_AHEAD = int(os.environ.get("SPOTIFY_TOKEN_REFRESH_AHEAD", 5 * 60))
+
+# Client credentials (app) tokens, shared by every request and scrape in the process
+# Stands in for spotipy's SpotifyClientCredentials, which only fetches a new token once the
+# old one has expired, and blocks whichever request finds it expired while it does
+class CachedClientCredentials():
+    def __init__(self, client_id, client_secret, refresh_ahead=TOKEN_REFRESH_AHEAD):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_ahead = refresh_ahead
+        self.token_info = None
+        # guards token_info and fetching, and is never held while talking to Spotify
+        self.lock = threading.Lock()
+        # Future of the token request in flight, if any, so that only one is made at a time
+        self.fetching = None
+
+    def request_token(self):
+        response = http_client.post(SPOTIFY_TOKEN_URL, data={ "grant_type" : "client_credentials" },
+                                    auth=(self.client_id, self.client_secret))
+        if response.status_code != 200:
+            raise RuntimeError("Failed to get an app token from Spotify ({}).".format(response.status_code))
+
+        token_info = response.json()
+        token_info["expires_at"] = time.time() + token_info["expires_in"]
+        return token_info
+
+    # Requests a token and swaps it in, then hands it (or the error) to everyone waiting on future
+    def fetch(self, future):
+        try:
+            token_info = self.request_token()
+        except BaseException as e:
+            with self.lock:
+                self.fetching = None
+            future.set_exception(e)
+            return
+
+        with self.lock:
+            self.token_info = token_info
+            self.fetching = None
+        future.set_result(token_info)
+
+    # Returns a new token, from a request made now or from the one already in flight
+    def refresh(self):
+        with self.lock:
+            future = self.fetching
+            start_fetch = future is None
+            if start_fetch:
+                future = self.fetching = Future()
+
+        if start_fetch:
+            self.fetch(future)
+        return future.result()
+
+    def refresh_in_background(self, future):
+        self.fetch(future)
+        if future.exception() is not None:
+            # the current token is still valid, and the next request tries again
+            logging.error("Failed to refresh the app token.", exc_info=future.exception())
+
+    # Same signature as spotipy's credentials managers: newer spotipy versions pass as_dict=False
+    def get_access_token(self, as_dict=False):
+        with self.lock:
+            token_info = self.token_info
+            remaining = token_info["expires_at"] - time.time() if token_info else 0
+            start_refresh = 0 < remaining < self.refresh_ahead and self.fetching is None
+            if start_refresh:
+                self.fetching = Future()
+                threading.Thread(target=self.refresh_in_background, args=(self.fetching,), daemon=True).start()
+
+        if remaining <= 0:
+            # only one thread requests the token, the others wait for it
+            token_info = self.refresh()
+
+        return dict(token_info) if as_dict else token_info["access_token"]
+
 def create_spotipy_client_session(client_id, client_secret):
+    # imported here so that the routes that don't talk to Spotify's API don't have to load spotipy
+    import spotipy
+
     try:
-        client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-        spotipy_session = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+        client_credentials_manager = CachedClientCredentials(client_id, client_secret)
+        # Share the pooled HTTP session so audio feature / artist lookups reuse warm connections
+        spotipy_session = spotipy.Spotify(client_credentials_manager=client_credentials_manager,
+                                          requests_session=http_client.get_session(),
+                                          requests_timeout=http_client.TIMEOUT)
     except Exception as e:
         logging.error("Failed to create Spotipy session.\n" + e)
     
-    return spotipy_session
\ No newline at end of file
+    return spotipy_session
+
+_spotipy_sessions = {}
+_spotipy_sessions_lock = threading.Lock()
+
+# Returns the process wide spotipy client for these credentials, creating it on first use
+# It is safe to share between threads: its HTTP session is http_client's, and its app token
+# is kept fresh by CachedClientCredentials
+def get_spotipy_client_session(client_id, client_secret):
+    key = (client_id, client_secret)
+    with _spotipy_sessions_lock:
+        if key not in _spotipy_sessions:
+            _spotipy_sessions[key] = create_spotipy_client_session(client_id, client_secret)
+
+        return _spotipy_sessions[key]
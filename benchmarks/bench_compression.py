@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Benchmarks the codecs in compression.py on track partitions: compression ratio, compress
+# and decompress speed, and how many DynamoDB items scrape_db.partition_and_compress_list
+# needs for the whole library
+#
+# usage: python benchmarks/bench_compression.py [--tracks 20000] [--codecs zlib:6 zstd:3 ...]
+import os
+import sys
+import json
+import time
+import argparse
+
+from bench_library_reads import make_tracks
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import compression
+import scrape_db
+
+DEFAULT_CODECS = ["zlib:1", "zlib:6", "zlib:9", "zstd:3", "zstd:9", "zstd:19"]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tracks", type=int, default=20000)
+    parser.add_argument("--partition-tracks", type=int, default=1000,
+                        help="tracks per partition for the ratio and speed measurements")
+    parser.add_argument("--codecs", nargs="+", default=DEFAULT_CODECS)
+    args = parser.parse_args()
+
+    tracks = make_tracks(args.tracks)
+
+    chunks = [json.dumps(tracks[i:i + args.partition_tracks]).encode("utf-8")
+              for i in range(0, len(tracks), args.partition_tracks)]
+    raw_size = sum(len(chunk) for chunk in chunks)
+
+    print(f"{len(tracks)} tracks, {raw_size / 1024:.0f} KB of JSON")
+    print(f"{'codec':<14} {'ratio':>6} {'compress MB/s':>14} {'decompress MB/s':>16} {'items':>6} {'partition (s)':>14}")
+    for name in args.codecs:
+        codec = compression.create_codec(name)
+
+        start = time.perf_counter()
+        compressed = [codec.compress(chunk) for chunk in chunks]
+        compress_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        decompressed = [codec.decompress(blob[1:]) for blob in compressed]
+        decompress_time = time.perf_counter() - start
+        assert decompressed == chunks, f"{name} didn't round trip"
+
+        start = time.perf_counter()
+        partitions = scrape_db.partition_and_compress_list(tracks, codec=codec)
+        partition_time = time.perf_counter() - start
+        assert max(len(partition) for partition in partitions) <= scrape_db.MAX_PARTITION_SIZE
+
+        ratio = raw_size / sum(len(blob) for blob in compressed)
+        print(f"{name:<14} {ratio:>6.2f} {raw_size / compress_time / 1e6:>14.1f} {raw_size / decompress_time / 1e6:>16.1f}"
+              f" {len(partitions):>6} {partition_time:>14.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Benchmarks writing a scraped library to DynamoDB the way scrape_db.scrape_library used to
+# (one update_item per attribute and per track partition, one after another) against
+# DataBase.update_many and DataBase.batch_write
+#
+# Runs against moto unless DYNAMODB_ENDPOINT_URL is set, see local_dynamodb.py
+#
+# usage: python benchmarks/bench_db_writes.py [--partitions 1 10 30] [--latency 0.02]
+import os
+import time
+import argparse
+
+from local_dynamodb import local_table
+
+PARTITION_SIZE = 350 * 1024
+
+def make_partitions(num_partitions):
+    return [os.urandom(PARTITION_SIZE) for _ in range(num_partitions)]
+
+def write_one_by_one(database, user_id, partitions):
+    database.update(user_id, "profile", { "id" : user_id })
+    database.update(user_id, "scrape_time", 0)
+    database.update(user_id, "message", "Scraping library")
+    partition_keys = []
+    for i, partition in enumerate(partitions):
+        partition_key = f"{user_id}_tracks_{i}"
+        partition_keys.append(partition_key)
+        database.update(partition_key, "tracks", partition)
+    database.update(user_id, "partition_keys", partition_keys)
+    database.update(user_id, "message", "Done")
+
+def write_batched(database, user_id, partitions):
+    database.update_many(user_id, { "profile" : { "id" : user_id }, "scrape_time" : 0, "message" : "Scraping library" })
+    partition_keys = [f"{user_id}_tracks_{i}" for i in range(len(partitions))]
+    database.batch_write([{ database.primary_key : key, "tracks" : partition }
+                          for key, partition in zip(partition_keys, partitions)])
+    database.update_many(user_id, { "partition_keys" : partition_keys, "message" : "Done" })
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--partitions", type=int, nargs="+", default=[1, 10, 30])
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="simulated round trip per request in seconds")
+    args = parser.parse_args()
+
+    print(f"{'partitions':>10} {'one by one':>18} {'batched':>18}")
+    for num_partitions in args.partitions:
+        partitions = make_partitions(num_partitions)
+        results = []
+        for write in [write_one_by_one, write_batched]:
+            with local_table(latency=args.latency) as (database, requests):
+                start = time.perf_counter()
+                write(database, "bench_user", partitions)
+                elapsed = time.perf_counter() - start
+
+                stored = database.get(f"bench_user_tracks_{num_partitions - 1}")["tracks"].value
+                assert stored == partitions[-1], "partition was not written"
+                results.append(f"{elapsed:6.2f} s {sum(requests.values()):4d} req")
+        print(f"{num_partitions:>10} {results[0]:>18} {results[1]:>18}")
+
+if __name__ == "__main__":
+    main()
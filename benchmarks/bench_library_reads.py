@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Benchmarks reading a library that scrape_db.scrape_library wrote to DynamoDB: one
+# DataBase.get per partition, one after another, against scrape_db.load_library
+#
+# Runs against moto unless DYNAMODB_ENDPOINT_URL is set, see local_dynamodb.py
+#
+# usage: python benchmarks/bench_library_reads.py [--partitions 10 20 30] [--latency 0.02]
+import os
+import sys
+import time
+import random
+import argparse
+
+from local_dynamodb import local_table
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import scrape_db
+
+FEATURES = ['energy', 'liveness', 'speechiness', 'acousticness', 'instrumentalness',
+            'danceability', 'loudness', 'valence', 'tempo']
+
+# Tracks shaped like the ones scrape_db.compile_library builds
+def make_tracks(num_tracks, seed=0, start=0):
+    rng = random.Random(seed)
+    tracks = []
+    for i in range(start, start + num_tracks):
+        track = {
+            "date" : "2020-01-01T00:00:00Z", "name" : f"Track {i}", "id" : f"{i:022d}", "popularity" : rng.randrange(100),
+            "uri" : f"spotify:track:{i:022d}",
+            "artists" : [{ "name" : f"Artist {rng.randrange(5000)}", "id" : f"{rng.randrange(5000):022d}" }],
+            "genres" : [f"genre {rng.randrange(3000)}" for _ in range(rng.randrange(6))],
+        }
+        track.update({ feature : rng.random() for feature in FEATURES })
+        tracks.append(track)
+
+    return tracks
+
+def make_partitions(num_partitions, tracks_per_partition=1000, seed=0):
+    return [scrape_db.compress_data(make_tracks(tracks_per_partition, seed=seed + p, start=p * tracks_per_partition))
+            for p in range(num_partitions)]
+
+def read_one_by_one(database, user_id):
+    tracks = []
+    for partition_key in database.get(user_id)["partition_keys"]:
+        tracks += scrape_db.decompress_data(database.get(partition_key)["tracks"].value)
+
+    return tracks
+
+# Time until the first track is available, and until all of them are
+def time_read(read):
+    start = time.perf_counter()
+    tracks = read()
+    first = None
+    all_tracks = []
+    for track in tracks:
+        if first is None:
+            first = time.perf_counter() - start
+        all_tracks.append(track)
+
+    return first, time.perf_counter() - start, all_tracks
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--partitions", type=int, nargs="+", default=[10, 20, 30])
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="simulated round trip per request in seconds")
+    args = parser.parse_args()
+
+    print(f"{'partitions':>10} {'tracks':>7} {'one by one (s)':>15} {'load_library (s)':>17} {'first track (s)':>16}")
+    for num_partitions in args.partitions:
+        partitions = make_partitions(num_partitions)
+        with local_table(latency=args.latency) as (database, requests):
+            partition_keys = [f"bench_user_tracks_{i}" for i in range(num_partitions)]
+            database.batch_write([{ database.primary_key : key, "tracks" : partition }
+                                  for key, partition in zip(partition_keys, partitions)])
+            database.update_many("bench_user", { "partition_keys" : partition_keys, "message" : "Done" })
+
+            _, old_time, old_tracks = time_read(lambda: read_one_by_one(database, "bench_user"))
+            first, new_time, new_tracks = time_read(lambda: scrape_db.load_library("bench_user", db=database, stream=True))
+            assert old_tracks == new_tracks, "libraries differ"
+
+        print(f"{num_partitions:>10} {len(new_tracks):>7} {old_time:>15.3f} {new_time:>17.3f} {first:>16.3f}")
+
+if __name__ == "__main__":
+    main()
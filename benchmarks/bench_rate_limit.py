@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Benchmarks many threads requesting pages from a simulated Spotify that allows --limit requests
+# per second and answers anything over that with a 429 and "Retry-After: 1", comparing the
+# retry loop api_call.get / scrape_db.get used to have (each request sleeping 4, 5, 6...
+# seconds on its own) with http_client's shared rate limiter
+#
+# usage: python benchmarks/bench_rate_limit.py [--threads 16] [--requests 1000] [--limit 100]
+import os
+import sys
+import time
+import logging
+import threading
+import argparse
+import collections
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import http_client
+import rate_limit
+
+URL = "https://api.spotify.com/v1/me/tracks"
+
+# Allows limit requests in any one second window, with latency seconds per request
+class FakeSpotify(requests.adapters.BaseAdapter):
+    def __init__(self, limit, latency):
+        super().__init__()
+        self.limit = limit
+        self.latency = latency
+        self.sent = collections.deque()
+        self.lock = threading.Lock()
+        self.throttled = 0
+
+    def send(self, request, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            now = time.monotonic()
+            while self.sent and now - self.sent[0] > 1:
+                self.sent.popleft()
+            allowed = len(self.sent) < self.limit
+            if allowed:
+                self.sent.append(now)
+            else:
+                self.throttled += 1
+
+        response = requests.Response()
+        response.status_code = 200 if allowed else 429
+        response.reason = "OK" if allowed else "Too Many Requests"
+        if not allowed:
+            response.headers["Retry-After"] = "1"
+        response._content = b"{}"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+def legacy_get(session, url, max_retries=10, delay=4):
+    response = session.get(url)
+    if response.status_code == 429 and max_retries > 0:
+        time.sleep(delay)
+        return legacy_get(session, url, max_retries=max_retries - 1, delay=delay + 1)
+    return response
+
+def run(get, num_threads, num_requests):
+    remaining = [num_requests]
+    lock = threading.Lock()
+    failures = [0]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            if get().status_code != 200:
+                with lock:
+                    failures[0] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - start, failures[0]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=100, help="requests per second Spotify allows")
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+    # don't log every retry
+    logging.getLogger().setLevel(logging.ERROR)
+
+    print(f"{args.requests} requests from {args.threads} threads, {args.limit} requests / second allowed")
+    print(f"{'':<14} {'time (s)':>9} {'requests/s':>11} {'429s':>6} {'failed':>7}")
+
+    legacy_spotify = FakeSpotify(args.limit, args.latency)
+    session = requests.Session()
+    session.mount("https://", legacy_spotify)
+    elapsed, failures = run(lambda: legacy_get(session, URL), args.threads, args.requests)
+    print(f"{'sleep + retry':<14} {elapsed:>9.2f} {args.requests / elapsed:>11.1f} {legacy_spotify.throttled:>6} {failures:>7}")
+
+    spotify = FakeSpotify(args.limit, args.latency)
+    # configured a little under what Spotify allows, as SPOTIFY_RATE_LIMIT would be
+    limiter = rate_limit.RateLimiter(rate=0.9 * args.limit, burst=args.limit // 10)
+    session = http_client.RateLimitedSession(limiter)
+    session.mount("https://", spotify)
+    elapsed, failures = run(lambda: session.get(URL), args.threads, args.requests)
+    print(f"{'rate limiter':<14} {elapsed:>9.2f} {args.requests / elapsed:>11.1f} {spotify.throttled:>6} {failures:>7}")
+
+if __name__ == "__main__":
+    main()
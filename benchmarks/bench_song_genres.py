@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Benchmarks the grouping step of utils.get_song_genres (tracks -> artists -> genres)
+# against the previous implementation, which scanned the whole artist array with
+# np.where once per track
+#
+# Artist genres are looked up from a precomputed table so that only the grouping is timed
+#
+# usage: python benchmarks/bench_song_genres.py [--sizes 1000 10000 50000] [--legacy-max 50000]
+import os
+import sys
+import time
+import random
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import utils
+
+NUM_ARTISTS = 5000
+NUM_GENRES = 3000
+
+def make_tracks(num_tracks, seed=0):
+    rng = random.Random(seed)
+    genre_table = {
+        f"spotify:artist:{i}" : [f"genre {rng.randrange(NUM_GENRES)}" for _ in range(rng.randrange(0, 6))]
+        for i in range(NUM_ARTISTS)
+    }
+    tracks = []
+    for i in range(num_tracks):
+        artists = [rng.randrange(NUM_ARTISTS) for _ in range(rng.choice([1, 1, 1, 2, 2, 3]))]
+        tracks.append({
+            "track" : {
+                "artists" : [{ "uri" : f"spotify:artist:{a}", "name" : f"Artist {a}" } for a in artists]
+            }
+        })
+
+    return tracks, genre_table
+
+# The implementation get_song_genres used to have
+def legacy_get_song_genres(tracks, genre_table):
+    num_tracks = len(tracks)
+
+    all_artists = []
+    all_artist_names = []
+    index = []
+    for i, track in enumerate(tracks):
+        artists = track['track']['artists']
+        for artist in artists:
+            all_artists.append(artist['uri'])
+            all_artist_names.append(artist['name'])
+            index.append(i)
+
+    all_artists = np.array(all_artists)
+    all_artist_names = np.array(all_artist_names)
+    index = np.array(index)
+    # build an object array explicitly since np.array() on ragged lists depends on the numpy version
+    all_genres = np.empty(len(all_artists), dtype=object)
+    all_genres[:] = [genre_table[uri] for uri in all_artists]
+
+    genres = []
+    artist_uris = []
+    artist_names = []
+    track_indices = np.arange(num_tracks)
+    for track_index in track_indices:
+        genres.append(sum(all_genres[np.where(track_index == index)], []))
+        artist_uris.append(list(all_artists[np.where(track_index == index)]))
+        artist_names.append(list(all_artist_names[np.where(track_index == index)]))
+
+    return artist_names, artist_uris, genres
+
+def time_it(f, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--legacy-max", type=int, default=50000,
+                        help="skip the old implementation above this many tracks (it is quadratic)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # Serve artist genres from the precomputed table instead of Spotify / the cache
+    genre_table = {}
+    utils.get_artists_genres = lambda artists, *_, **__: [genre_table[uri] for uri in artists]
+
+    print(f"{'tracks':>8} {'grouped (s)':>12} {'np.where (s)':>13} {'speedup':>8}")
+    for num_tracks in args.sizes:
+        tracks, table = make_tracks(num_tracks)
+        genre_table.clear()
+        genre_table.update(table)
+
+        new_time, new_result = time_it(lambda: utils.get_song_genres(tracks, None), args.repeat)
+        if num_tracks <= args.legacy_max:
+            old_time, old_result = time_it(lambda: legacy_get_song_genres(tracks, table), 1)
+            assert [list(map(str, l)) for part in old_result for l in part] == \
+                   [l for part in new_result for l in part], "outputs differ"
+            print(f"{num_tracks:>8} {new_time:>12.4f} {old_time:>13.4f} {old_time / new_time:>7.0f}x")
+        else:
+            print(f"{num_tracks:>8} {new_time:>12.4f} {'skipped':>13} {'':>8}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# Benchmarks cold starts: the time to import main:app / scrape_db and to answer the first
+# request in a fresh interpreter, which is what every main.cgi request and every cold Lambda pays
+#
+# Every measurement runs in its own child process, and the median over --repeat runs is reported,
+# along with which of the heavy dependencies (numpy, spotipy, boto3) had been imported by then
+#
+# The first call of scrape_db.lambda_handler runs against moto's in-memory DynamoDB and a canned
+# Spotify API, so it needs moto installed but no network access or AWS account. moto imports
+# boto3 itself, so the time it takes to import boto3 is measured separately
+#
+# usage: python benchmarks/bench_startup.py [--repeat 5] [--paths / /login /status/bench_user]
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HEAVY_MODULES = ["numpy", "spotipy", "boto3"]
+NUM_TRACKS = 500
+
+def loaded_heavy_modules():
+    return [module for module in HEAVY_MODULES if module in sys.modules]
+
+def child_main(path):
+    start = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+    loaded_at_import = loaded_heavy_modules()
+
+    client = main.app.test_client()
+    start_request = time.perf_counter()
+    response = client.get(path)
+    requested = time.perf_counter()
+
+    return {
+        "import" : imported - start,
+        "request" : requested - start_request,
+        "status" : response.status_code,
+        "loaded_at_import" : loaded_at_import,
+        "loaded_after_request" : loaded_heavy_modules(),
+    }
+
+def child_boto3():
+    start = time.perf_counter()
+    import boto3
+    boto3.client("dynamodb")
+    boto3.resource("dynamodb")
+
+    return { "import" : time.perf_counter() - start }
+
+# Answers the Spotify API requests that scrape_db makes for a user with NUM_TRACKS saved tracks
+def make_fake_spotify():
+    from urllib.parse import urlparse, parse_qs
+    import requests
+
+    class FakeSpotify(requests.adapters.BaseAdapter):
+        def send(self, request, **kwargs):
+            url = urlparse(request.url)
+            query = parse_qs(url.query)
+            if url.path == "/v1/me":
+                body = { "id" : "bench_user", "display_name" : "Bench" }
+            elif url.path == "/v1/me/tracks":
+                offset = int(query.get("offset", [0])[0])
+                limit = int(query.get("limit", [20])[0])
+                body = {
+                    "total" : NUM_TRACKS,
+                    "limit" : limit,
+                    "items" : [{
+                        "added_at" : "2020-01-01T00:00:00Z",
+                        "track" : {
+                            "name" : f"Track {i}", "id" : f"t{i}", "popularity" : i % 100,
+                            "uri" : f"spotify:track:t{i}",
+                            "artists" : [{ "name" : f"Artist {i % 50}", "id" : f"a{i % 50}", "uri" : f"spotify:artist:a{i % 50}" }],
+                        },
+                    } for i in range(offset, min(offset + limit, NUM_TRACKS))],
+                }
+            elif url.path == "/v1/audio-features":
+                features = ['energy', 'liveness', 'speechiness', 'acousticness', 'instrumentalness',
+                            'danceability', 'loudness', 'valence', 'tempo']
+                body = { "audio_features" : [{ feature : 0.5 for feature in features } for _ in query["ids"][0].split(",")] }
+            elif url.path == "/v1/artists":
+                body = { "artists" : [{ "genres" : ["pop", "indie pop"] } for _ in query["ids"][0].split(",")] }
+            else:
+                raise ValueError(f"Unexpected request to {request.url}")
+
+            response = requests.Response()
+            response.status_code = 200
+            response.reason = "OK"
+            response._content = json.dumps(body).encode("utf-8")
+            response.headers["Content-Type"] = "application/json"
+            response.url = request.url
+            response.request = request
+            return response
+
+        def close(self):
+            pass
+
+    return FakeSpotify()
+
+def child_lambda():
+    start = time.perf_counter()
+    import scrape_db
+    imported = time.perf_counter()
+    loaded_at_import = loaded_heavy_modules()
+
+    import boto3
+    from moto import mock_aws
+    import http_client
+
+    with mock_aws():
+        boto3.client("dynamodb").create_table(
+            TableName="Wayfinder",
+            KeySchema=[{ "AttributeName" : "user_id", "KeyType" : "HASH" }],
+            AttributeDefinitions=[{ "AttributeName" : "user_id", "AttributeType" : "S" }],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        http_client.get_session().mount("https://api.spotify.com", make_fake_spotify())
+
+        start_request = time.perf_counter()
+        response = scrape_db.lambda_handler({ "token" : "bench" }, None)
+        requested = time.perf_counter()
+
+    return {
+        "import" : imported - start,
+        "request" : requested - start_request,
+        "status" : response["statusCode"],
+        "loaded_at_import" : loaded_at_import,
+    }
+
+def run_child(args, env):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"] + args, cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+def run(args, env, repeat):
+    results = []
+    for _ in range(repeat):
+        # a fresh, empty lookup cache each time, so no run benefits from an earlier one
+        with tempfile.TemporaryDirectory() as cache_dir:
+            env["WAYFINDER_CACHE_DB"] = os.path.join(cache_dir, "cache.sqlite")
+            results.append(run_child(args, env))
+
+    summary = dict(results[-1])
+    for key in ["import", "request"]:
+        if key in summary:
+            summary[key] = statistics.median(result[key] for result in results)
+
+    return summary
+
+def ms(seconds):
+    return f"{seconds * 1000:.0f} ms"
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--paths", nargs="+", default=["/", "/login", "/status/bench_user"])
+    parser.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, ROOT)
+        kind = args.child[0]
+        if kind == "main":
+            result = child_main(args.child[1])
+        elif kind == "boto3":
+            result = child_boto3()
+        else:
+            result = child_lambda()
+        print(json.dumps(result))
+        return
+
+    env = dict(os.environ)
+    env.setdefault("CLIENT_ID", "bench")
+    env.setdefault("CLIENT_SECRET", "bench")
+    env.setdefault("APP_URL", "http://localhost")
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    env.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    env.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+
+    print(f"main:app (median of {args.repeat})")
+    for path in args.paths:
+        result = run(["main", path], env, args.repeat)
+        print(f"  {path:<24} import {ms(result['import']):>8}   first request {ms(result['request']):>8} ({result['status']})"
+              f"   loaded: {', '.join(result['loaded_after_request']) or '-'}")
+
+    print(f"scrape_db.lambda_handler (median of {args.repeat}, {NUM_TRACKS} tracks)")
+    boto3_import = run(["boto3"], env, args.repeat)["import"]
+    try:
+        result = run(["lambda"], env, args.repeat)
+        print(f"  import {ms(result['import'])} (loaded: {', '.join(result['loaded_at_import']) or '-'})"
+              f"   first request {ms(result['request'])} + boto3 {ms(boto3_import)}")
+    except subprocess.CalledProcessError:
+        print(f"  could not run lambda_handler (is moto installed?), boto3 import {ms(boto3_import)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# A DynamoDB table for benchmarks to run against
+# By default this is moto's in-memory DynamoDB; set DYNAMODB_ENDPOINT_URL to use e.g.
+# DynamoDB Local instead (java -jar DynamoDBLocal.jar -inMemory, then http://localhost:8000)
+#
+# Requests to moto take almost no time, which hides the cost of making many of them, so each
+# request can be given a simulated network round trip with latency (seconds)
+import os
+import sys
+import time
+import collections
+from contextlib import contextmanager, ExitStack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import db
+
+for key, value in [("AWS_DEFAULT_REGION", "us-east-1"), ("AWS_ACCESS_KEY_ID", "bench"), ("AWS_SECRET_ACCESS_KEY", "bench")]:
+    os.environ.setdefault(key, value)
+
+# Yields (DataBase, requests), where requests counts the requests made per operation
+@contextmanager
+def local_table(table_name="Wayfinder", primary_key="user_id", latency=0.0):
+    with ExitStack() as stack:
+        if db.ENDPOINT_URL is None:
+            from moto import mock_aws
+            stack.enter_context(mock_aws())
+        # clients created outside of the mock would talk to AWS
+        db._dynamodb = None
+        dynamodb, client = db.get_dynamodb()
+
+        if table_name in client.list_tables()["TableNames"]:
+            client.delete_table(TableName=table_name)
+            client.get_waiter("table_not_exists").wait(TableName=table_name)
+        client.create_table(
+            TableName=table_name,
+            KeySchema=[{ "AttributeName" : primary_key, "KeyType" : "HASH" }],
+            AttributeDefinitions=[{ "AttributeName" : primary_key, "AttributeType" : "S" }],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        client.get_waiter("table_exists").wait(TableName=table_name)
+
+        requests = collections.Counter()
+        def before_send(request, **kwargs):
+            requests[request.headers["X-Amz-Target"].decode().split(".")[-1]] += 1
+            if latency:
+                time.sleep(latency)
+        for events in [client.meta.events, dynamodb.meta.client.meta.events]:
+            events.register("before-send.dynamodb", before_send)
+
+        yield db.DataBase(table_name), requests
+
+        client.delete_table(TableName=table_name)
+        db._dynamodb = None
@@ -0,0 +1,485 @@
+import os
+import json
+import time
+import sqlite3
+import shutil
+import logging
+import threading
+import collections
+
+# Caches that are shared between users, scrapes and worker processes
+# Entries live in a SQLite database (one table per cache) so that they survive restarts
+# and can be read by every gunicorn worker / warm Lambda container on the machine
+CACHE_DB = os.environ.get("WAYFINDER_CACHE_DB", "/tmp/data/cache.sqlite")
+
+# Maximum number of track ids to keep audio features for
+AUDIO_FEATURES_MAX_ENTRIES = int(os.environ.get("AUDIO_FEATURES_CACHE_SIZE", 250000))
+# Maximum number of artist ids to keep genres for, and how long (seconds) before they are
+# looked up again since Spotify does occasionally re-tag artists
+ARTIST_GENRES_MAX_ENTRIES = int(os.environ.get("ARTIST_GENRES_CACHE_SIZE", 100000))
+ARTIST_GENRES_TTL = int(os.environ.get("ARTIST_GENRES_CACHE_TTL", 7 * 24 * 60 * 60))
+# Total size in bytes that the per user data folders may take up, and how long (seconds)
+# a user's data is kept after it was last written
+USER_DATA_MAX_BYTES = int(os.environ.get("USER_DATA_CACHE_BYTES", 1024 ** 3))
+USER_DATA_TTL = int(os.environ.get("USER_DATA_CACHE_TTL", 30 * 24 * 60 * 60))
+# An entry's last access time is only written when it is older than this many seconds, so that
+# reads don't take SQLite's write lock every time; eviction order is only this precise
+ACCESS_RESOLUTION = int(os.environ.get("CACHE_ACCESS_RESOLUTION", 60 * 60))
+# Maximum number of access tokens to keep the user's profile for, and for how long (seconds)
+# Access tokens are only valid for an hour, so entries don't need to outlive that
+PROFILE_MAX_ENTRIES = int(os.environ.get("PROFILE_CACHE_SIZE", 10000))
+PROFILE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", 60 * 60))
+
+class SqliteCache():
+    # name is the table that holds this cache's entries
+    # max_entries bounds the size of the cache, evicting the least recently used entries
+    # ttl (seconds) expires entries that were written longer ago than that, None never expires
+    # access_resolution (seconds) is how stale an entry's recorded access time may get
+    def __init__(self, name, path=CACHE_DB, max_entries=None, ttl=None, access_resolution=ACCESS_RESOLUTION):
+        self.name = name
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.access_resolution = access_resolution
+        self.sweep_interval = sweep_interval
+        # when this process last scanned root, see evict
+        self.last_sweep = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stats_lock = threading.Lock()
+
+        # sqlite connections can't be shared between threads
+        self.local = threading.local()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = self.connect()
+        # one transaction, so that the row count starts out right even if another process is
+        # writing to the table at the same time
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.name} "
+                "(key TEXT PRIMARY KEY, value TEXT, written REAL, accessed REAL)"
+            )
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.name}_accessed ON {self.name} (accessed)")
+            # the number of rows of every cache, kept up to date by triggers, so that checking
+            # whether to evict doesn't have to count the table
+            connection.execute("CREATE TABLE IF NOT EXISTS cache_sizes (name TEXT PRIMARY KEY, size INTEGER)")
+            connection.execute(
+                f"INSERT OR IGNORE INTO cache_sizes (name, size) SELECT ?, COUNT(*) FROM {self.name}", (self.name,)
+            )
+            connection.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {self.name}_insert AFTER INSERT ON {self.name} BEGIN "
+                f"UPDATE cache_sizes SET size = size + 1 WHERE name = '{self.name}'; END"
+            )
+            connection.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {self.name}_delete AFTER DELETE ON {self.name} BEGIN "
+                f"UPDATE cache_sizes SET size = size - 1 WHERE name = '{self.name}'; END"
+            )
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+
+    def connect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            # write ahead logging lets other processes keep reading while we write
+            connection.execute("PRAGMA journal_mode=WAL")
+            # so that the rows INSERT OR REPLACE deletes fire the delete trigger, which keeps
+            # cache_sizes right
+            connection.execute("PRAGMA recursive_triggers=ON")
+            self.local.connection = connection
+
+        return connection
+
+    # Returns a dictionary with an entry for every key that is in the cache
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        # entries whose recorded access time is too old to leave as it is
+        touched = []
+        now = time.time()
+        connection = self.connect()
+        # stay below SQLite's limit on the number of query parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = connection.execute(
+                f"SELECT key, value, written, accessed FROM {self.name} WHERE key IN ({placeholders})", chunk
+            ).fetchall()
+            for key, value, written, accessed in rows:
+                if self.ttl is None or now - written < self.ttl:
+                    found[key] = json.loads(value)
+                    if now - accessed >= self.access_resolution:
+                        touched.append(key)
+
+        if touched:
+            with connection:
+                connection.executemany(
+                    f"UPDATE {self.name} SET accessed = ? WHERE key = ?", [(now, key) for key in touched]
+                )
+
+        with self.stats_lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return found
+
+    def put_many(self, items):
+        if not items:
+            return
+
+        now = time.time()
+        connection = self.connect()
+        with connection:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO {self.name} (key, value, written, accessed) VALUES (?, ?, ?, ?)",
+                [(key, json.dumps(value), now, now) for key, value in items.items()]
+            )
+        self.evict()
+
+    def evict(self):
+        if self.max_entries is None:
+            return
+
+        connection = self.connect()
+        size = self.size()
+        if size <= self.max_entries:
+            return
+
+        # evict down to 90% of the limit so that we don't evict on every write
+        num_evict = size - int(0.9 * self.max_entries)
+        with connection:
+            connection.execute(
+                f"DELETE FROM {self.name} WHERE key IN "
+                f"(SELECT key FROM {self.name} ORDER BY accessed LIMIT ?)", (num_evict,)
+            )
+        with self.stats_lock:
+            self.evictions += num_evict
+        logging.info(f"Evicted {num_evict} entries from the {self.name} cache.")
+
+    def size(self):
+        return self.connect().execute("SELECT size FROM cache_sizes WHERE name = ?", (self.name,)).fetchone()[0]
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "size" : self.size(),
+            }
+
+# A cache that lives in this process's memory, for small values that are cheap to lose
+# Same bounds as SqliteCache: at most max_entries, least recently used evicted first, and
+# entries older than ttl seconds expire
+class MemoryCache():
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (value, written), least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns the value for key, or None if it isn't cached
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[1] >= self.ttl:
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "size" : len(self.entries),
+            }
+
+def get_folder_size(path):
+    size = 0
+    for directory, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(directory, file_name))
+            except OSError:
+                pass
+
+    return size
+
+# Keeps the sub folders of root (one per user) within a total byte budget
+# Whole folders are evicted, least recently accessed first, once the budget is exceeded, and
+# folders last written more than ttl seconds ago are expired
+# The folders' sizes and access times are kept in a table of the shared SQLite database, so that
+# every worker process sees the writes of the others and enforces the same budget. Folders that
+# aren't in the table yet (e.g. written before it existed) are added the next time it evicts
+# in_use is an optional callback that returns True for folders that must not be deleted right now
+class FolderCache():
+    # name is the table that holds the folders' sizes and access times
+    # access_resolution (seconds) is how stale a folder's recorded access time may get
+    # sweep_interval (seconds) is how often a write scans root for expired and unknown folders
+    # even when the cache is within budget
+    def __init__(self, root, max_bytes, ttl=None, in_use=None, name="folders", path=CACHE_DB,
+                 access_resolution=60, sweep_interval=60 * 60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.in_use = in_use
+        self.name = name
+        self.path = path
+        self.access_resolution = access_resolution
+        self.sweep_interval = sweep_interval
+        # when this process last scanned root, see evict
+        self.last_sweep = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stats_lock = threading.Lock()
+
+        # sqlite connections can't be shared between threads
+        self.local = threading.local()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.connect() as connection:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.name} "
+                "(name TEXT PRIMARY KEY, size INTEGER, accessed REAL, written REAL)"
+            )
+
+    def connect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+
+        return connection
+
+    def get_entry(self, name):
+        row = self.connect().execute(
+            f"SELECT size, accessed, written FROM {self.name} WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        return { "size" : row[0], "accessed" : row[1], "written" : row[2] }
+
+    def get_entries(self):
+        rows = self.connect().execute(f"SELECT name, size, accessed, written FROM {self.name}").fetchall()
+        return { name : { "size" : size, "accessed" : accessed, "written" : written }
+                 for name, size, accessed, written in rows }
+
+    def put_entry(self, name, size, accessed, written):
+        with self.connect() as connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO {self.name} (name, size, accessed, written) VALUES (?, ?, ?, ?)",
+                (name, size, accessed, written)
+            )
+
+    def get_total_size(self):
+        return self.connect().execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.name}").fetchone()[0]
+
+    def delete_entry(self, name):
+        with self.connect() as connection:
+            connection.execute(f"DELETE FROM {self.name} WHERE name = ?", (name,))
+
+    def get_folder(self, name):
+        return os.path.join(self.root, name)
+
+    # Adds the folders on disk that aren't in the table, and drops the rows of folders that
+    # are gone (e.g. deleted by hand)
+    # Returns the entries of every folder
+    def sync(self):
+        entries = self.get_entries()
+        folders = set()
+        if os.path.exists(self.root):
+            for entry in os.scandir(self.root):
+                if entry.is_dir():
+                    folders.add(entry.name)
+                    if entry.name not in entries:
+                        modified = entry.stat().st_mtime
+                        entries[entry.name] = { "size" : get_folder_size(entry.path), "accessed" : modified, "written" : modified }
+                        self.put_entry(entry.name, **entries[entry.name])
+
+        for name in list(entries):
+            if name not in folders:
+                self.delete_entry(name)
+                del entries[name]
+
+        return entries
+
+    def is_expired(self, entry):
+        return self.ttl is not None and time.time() - entry["written"] > self.ttl
+
+    def is_in_use(self, name):
+        return self.in_use is not None and self.in_use(name)
+
+    def count(self, counter):
+        with self.stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    # True if the folder is cached and hasn't expired; expired folders are deleted
+    def lookup(self, name):
+        folder = self.get_folder(name)
+        entry = self.get_entry(name)
+        if not os.path.exists(folder):
+            # never written, or deleted by another process
+            if entry is not None:
+                self.delete_entry(name)
+            self.count("misses")
+            return False
+
+        known = entry is not None
+        if not known:
+            modified = os.path.getmtime(folder)
+            entry = { "size" : get_folder_size(folder), "accessed" : modified, "written" : modified }
+
+        if self.is_expired(entry) and not self.is_in_use(name):
+            self.remove(name)
+            self.count("expirations")
+            self.count("misses")
+            return False
+
+        self.count("hits")
+        if known:
+            self.touch(name, entry)
+        else:
+            self.put_entry(name, entry["size"], time.time(), entry["written"])
+        return True
+
+    # Record a read of the folder
+    # Only written when the recorded access time is more than access_resolution old, so that
+    # reads don't turn into writes
+    def touch(self, name, entry=None):
+        if entry is None:
+            entry = self.get_entry(name)
+        now = time.time()
+        if entry is not None and now - entry["accessed"] >= self.access_resolution:
+            with self.connect() as connection:
+                connection.execute(f"UPDATE {self.name} SET accessed = ? WHERE name = ?", (now, name))
+
+    # Record that the folder has been written to, then evict other folders if we are over budget
+    # Called while a folder is being written to as well, so that what has been written so far counts
+    # Only this folder is measured; the rest of root is only scanned when the sizes in the table
+    # add up to more than the budget, or every sweep_interval
+    def record_write(self, name):
+        now = time.time()
+        self.put_entry(name, get_folder_size(self.get_folder(name)), now, now)
+        if self.get_total_size() > self.max_bytes or \
+           self.last_sweep is None or now - self.last_sweep >= self.sweep_interval:
+            self.evict(keep=name)
+
+    def remove(self, name):
+        self.delete_entry(name)
+        shutil.rmtree(self.get_folder(name), ignore_errors=True)
+
+    def evict(self, keep=None):
+        self.last_sweep = time.time()
+        entries = self.sync()
+        for name, entry in list(entries.items()):
+            if name != keep and self.is_expired(entry) and not self.is_in_use(name):
+                self.remove(name)
+                self.count("expirations")
+                del entries[name]
+
+        total_size = sum(entry["size"] for entry in entries.values())
+        if total_size <= self.max_bytes:
+            return
+
+        by_access = sorted(entries.items(), key=lambda item: item[1]["accessed"])
+        for name, entry in by_access:
+            if total_size <= self.max_bytes:
+                break
+            if name == keep or self.is_in_use(name):
+                continue
+            logging.info(f"Evicting cached data of {name} ({entry['size'] / 1024:.1f} KB).")
+            self.remove(name)
+            self.count("evictions")
+            total_size -= entry["size"]
+
+    def stats(self):
+        entries = self.get_entries()
+        with self.stats_lock:
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "expirations" : self.expirations,
+                "entries" : len(entries),
+                "size" : sum(entry["size"] for entry in entries.values()),
+                "max_size" : self.max_bytes,
+            }
+
+# Looks up a value for every key, using the cache where possible
+# Only cache misses are passed to fetch, in batches of at most batch_size keys
+# fetch takes a list of keys and returns a list of values in the same order
+# (None for keys that have no value, which are not cached)
+# Returns a list of values in the same order as keys
+def cached_lookup(keys, cache, fetch, batch_size):
+    # each distinct key only needs to be looked up once
+    unique_keys = list(dict.fromkeys(keys))
+    found = cache.get_many(unique_keys)
+
+    misses = [key for key in unique_keys if key not in found]
+    for i in range(0, len(misses), batch_size):
+        batch = misses[i:i + batch_size]
+        values = fetch(batch)
+        fetched = { key : value for key, value in zip(batch, values) if value is not None }
+        cache.put_many(fetched)
+        found.update(fetched)
+
+    return [found.get(key) for key in keys]
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(name, **kwargs):
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = SqliteCache(name, **kwargs)
+
+        return _caches[name]
+
+# track id -> audio features
+# Audio features are public and the same for every user, so one cache serves everyone
+def get_audio_features_cache():
+    return get_cache("audio_features", max_entries=AUDIO_FEATURES_MAX_ENTRIES)
+
+# artist id -> genres
+def get_artist_genres_cache():
+    return get_cache("artist_genres", max_entries=ARTIST_GENRES_MAX_ENTRIES, ttl=ARTIST_GENRES_TTL)
+
+_profile_cache = MemoryCache(PROFILE_MAX_ENTRIES, ttl=PROFILE_TTL)
+
+# hash of an access token -> profile of the user it belongs to (see api_call.get_profile_data)
+# Kept in memory rather than SQLite since access tokens shouldn't be written to disk, even hashed
+def get_profile_cache():
+    return _profile_cache
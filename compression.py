@@ -0,0 +1,132 @@
+import os
+import zlib
+import threading
+
+# Compression codecs for the track partitions scrape_db writes to DynamoDB
+# Every compressed blob starts with a header byte naming the codec that wrote it, so that
+# blobs written with different codecs (or settings) can be read side by side:
+#   0x01  zlib
+#   0x02  zstd
+# Blobs written before there were codecs are plain zlib streams, which always start with 0x78
+#
+# zstd needs the zstandard package, which is only imported when a zstd codec is used
+
+ZLIB = 0x01
+ZSTD = 0x02
+LEGACY_ZLIB = 0x78
+
+# The codec scrape_db writes partitions with, e.g. "zlib", "zlib:9" or "zstd:3"
+TRACK_CODEC = os.environ.get("TRACK_CODEC", "zlib")
+
+class ZlibCodec():
+    header = ZLIB
+
+    def __init__(self, level=-1):
+        self.level = level
+
+    def compress(self, data):
+        return bytes([self.header]) + zlib.compress(data, self.level)
+
+    def decompress(self, payload):
+        return zlib.decompress(payload)
+
+    # Upper bound on the size n bytes compress to (zlib's compressBound)
+    def bound(self, n):
+        return n + (n >> 12) + (n >> 14) + (n >> 25) + 13
+
+    def compressobj(self):
+        return ZlibStream(zlib.compressobj(self.level))
+
+# Incremental compression; flush() makes everything compressed so far available, so that the
+# size of the output is known exactly, and copy() (if the codec supports it) snapshots the state
+class ZlibStream():
+    def __init__(self, compressor):
+        self.compressor = compressor
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+    def copy(self):
+        return ZlibStream(self.compressor.copy())
+
+class ZstdCodec():
+    header = ZSTD
+
+    def __init__(self, level=3):
+        import zstandard
+        self.zstandard = zstandard
+        self.level = level
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        # a compressor can't be used by several threads at once
+        self.lock = threading.Lock()
+
+    def compress(self, data):
+        with self.lock:
+            return bytes([self.header]) + self.compressor.compress(data)
+
+    def decompress(self, payload):
+        # a new decompressor per call, since streaming compressors write frames without their size
+        return self.zstandard.ZstdDecompressor().decompressobj().decompress(payload)
+
+    # Upper bound on the size n bytes compress to (ZSTD_COMPRESSBOUND), plus the frame's
+    # header and checksum
+    def bound(self, n):
+        margin = ((128 * 1024 - n) >> 11) if n < 128 * 1024 else 0
+        return n + (n >> 8) + margin + 32
+
+    def compressobj(self):
+        compressor = self.zstandard.ZstdCompressor(level=self.level)
+        return ZstdStream(self.zstandard, compressor.compressobj())
+
+# zstd's compressobj can't be copied, so ZstdStream has no copy()
+class ZstdStream():
+    def __init__(self, zstandard, compressor):
+        self.zstandard = zstandard
+        self.compressor = compressor
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(self.zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush(self.zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+# Parses a codec name, e.g. "zlib", "zlib:9" or "zstd:19"
+def create_codec(name):
+    name, _, level = name.partition(":")
+    if name == "zlib":
+        return ZlibCodec(int(level) if level else -1)
+    elif name == "zstd":
+        return ZstdCodec(int(level) if level else 3)
+
+    raise ValueError(f"Unknown codec '{name}'")
+
+_codecs = {}
+_codecs_lock = threading.Lock()
+
+def get_codec(name=TRACK_CODEC):
+    with _codecs_lock:
+        if name not in _codecs:
+            _codecs[name] = create_codec(name)
+
+        return _codecs[name]
+
+# Decompresses a blob written by any codec, or by plain zlib
+def decompress(data):
+    header = data[0]
+    if header == LEGACY_ZLIB:
+        return zlib.decompress(data)
+    elif header == ZLIB:
+        return zlib.decompress(data[1:])
+    elif header == ZSTD:
+        return get_codec("zstd").decompress(data[1:])
+
+    raise ValueError(f"Unknown compression header {header:#04x}")
@@ -1,18 +1,46 @@
-import boto3
+import os
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-class DataBase():
-    # Get the service resource.
-    dynamodb = boto3.resource('dynamodb')
-    # Get the service client
-    dynamodb_client = boto3.client('dynamodb')
+# Set to use a local stand in for DynamoDB, e.g. http://localhost:8000 for DynamoDB Local
+ENDPOINT_URL = os.environ.get("DYNAMODB_ENDPOINT_URL") or None
+# BatchWriteItem takes at most 25 items per request
+BATCH_WRITE_SIZE = 25
+# BatchGetItem takes at most 100 keys per request
+BATCH_GET_SIZE = 100
+
+# boto3 takes a while to import and to create clients with, so that is only done the first time
+# a table is opened rather than when this module is imported
+_dynamodb = None
+_dynamodb_client = None
+_dynamodb_lock = threading.Lock()
+
+# Returns the DynamoDB service resource and client, shared by every table
+def get_dynamodb():
+    global _dynamodb, _dynamodb_client
+    if _dynamodb is None:
+        with _dynamodb_lock:
+            if _dynamodb is None:
+                import boto3
+                _dynamodb_client = boto3.client('dynamodb', endpoint_url=ENDPOINT_URL)
+                _dynamodb = boto3.resource('dynamodb', endpoint_url=ENDPOINT_URL)
 
+    return _dynamodb, _dynamodb_client
+
+class DataBase():
     primary_key = None
 
     def __init__(self, table_name):
+        # Get the service resource and client
+        self.dynamodb, self.dynamodb_client = get_dynamodb()
         if table_name not in self.dynamodb_client.list_tables()['TableNames']:
             raise Exception(f"DynamoDB '{table_name}' does not exist!")
         else:
             self.table = self.dynamodb.Table(table_name)
+        self.table_name = table_name
 
         self.primary_key = self.table.key_schema[0]['AttributeName']
         
@@ -54,3 +82,77 @@ class DataBase():
                 ':val1': value
             }
         )
+
+    # Sets several attributes of an item in one round trip
+    def update_many(self, primary_key, values):
+        names = { f"#k{i}" : key for i, key in enumerate(values) }
+        self.table.update_item(
+            Key={
+                self.primary_key : primary_key
+            },
+            UpdateExpression="SET " + ", ".join(f"#k{i} = :v{i}" for i in range(len(values))),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={ f":v{i}" : value for i, value in enumerate(values.values()) }
+        )
+
+    # Writes (replaces) whole items, each a dictionary that includes the primary key
+    # Items are sent BATCH_WRITE_SIZE at a time, with up to max_workers batches in flight at once,
+    # and items that DynamoDB leaves unprocessed (e.g. when throttled) are sent again after a
+    # backoff, until max_retries is reached
+    def batch_write(self, items, max_workers=4, max_retries=8, delay=0.05):
+        from boto3.dynamodb.types import TypeSerializer
+        serializer = TypeSerializer()
+
+        def write_batch(batch):
+            requests = [{ "PutRequest" : { "Item" : { key : serializer.serialize(value) for key, value in item.items() } } }
+                        for item in batch]
+            for attempt in range(max_retries + 1):
+                # the client is thread safe, unlike the table resource
+                response = self.dynamodb_client.batch_write_item(RequestItems={ self.table_name : requests })
+                requests = response.get("UnprocessedItems", {}).get(self.table_name, [])
+                if not requests:
+                    return
+                if attempt < max_retries:
+                    logging.info(f"Retrying {len(requests)} unprocessed items.")
+                    time.sleep(delay * 2 ** attempt * random.uniform(0.5, 1.5))
+
+            raise RuntimeError(f"{len(requests)} items were still unprocessed after {max_retries} retries")
+
+        batches = [items[i:i + BATCH_WRITE_SIZE] for i in range(0, len(items), BATCH_WRITE_SIZE)]
+        if max_workers > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+                # list() re-raises the first error of any batch
+                list(executor.map(write_batch, batches))
+        else:
+            for batch in batches:
+                write_batch(batch)
+
+    # Gets the items with the given primary keys with BatchGetItem, in one request (up to
+    # BATCH_GET_SIZE keys) or more, and returns a dictionary of primary key -> item for the
+    # items that exist
+    # Keys that DynamoDB leaves unprocessed (e.g. when a response would exceed 16 MB) are
+    # requested again after a backoff, until max_retries is reached
+    # This only uses the client, so it can be called from several threads at once
+    def batch_get(self, primary_keys, max_retries=8, delay=0.05):
+        from boto3.dynamodb.types import TypeDeserializer
+        deserializer = TypeDeserializer()
+
+        found = {}
+        for i in range(0, len(primary_keys), BATCH_GET_SIZE):
+            request = { "Keys" : [{ self.primary_key : { "S" : key } } for key in primary_keys[i:i + BATCH_GET_SIZE]] }
+            for attempt in range(max_retries + 1):
+                response = self.dynamodb_client.batch_get_item(RequestItems={ self.table_name : request })
+                for item in response["Responses"].get(self.table_name, []):
+                    item = { key : deserializer.deserialize(value) for key, value in item.items() }
+                    found[item[self.primary_key]] = item
+
+                request = response.get("UnprocessedKeys", {}).get(self.table_name)
+                if not request:
+                    break
+                if attempt < max_retries:
+                    logging.info(f"Retrying {len(request['Keys'])} unprocessed keys.")
+                    time.sleep(delay * 2 ** attempt * random.uniform(0.5, 1.5))
+            else:
+                raise RuntimeError(f"{len(request['Keys'])} keys were still unprocessed after {max_retries} retries")
+
+        return found
@@ -0,0 +1,80 @@
+import threading
+
+import numpy as np
+
+import genre_table
+
+# Nearest genres to a set of audio features
+# Every genre in data_genres_average_features.json is a point in the space of the averaged
+# audio features of its songs. The features are on very different scales (tempo is ~100,
+# loudness ~-10, the rest 0..1), so they are standardized before computing distances,
+# otherwise tempo alone would decide which genres are closest
+# With ~3000 genres and 10 features an exact search is one small matrix product, so there is
+# no need for an approximate or tree based index
+
+# The same features, in the same order, as utils.featurize_tracks returns
+FEATURE_NAMES = ['energy', 'liveness', 'speechiness', 'acousticness', 'instrumentalness',
+                 'danceability', 'loudness', 'valence', 'tempo', 'popularity']
+
+class GenreIndex():
+    # features is a (num_genres, len(FEATURE_NAMES)) matrix
+    def __init__(self, names, uris, features):
+        self.names = names
+        self.uris = uris
+
+        features = np.asarray(features, dtype=np.float64)
+        self.mean = features.mean(axis=0)
+        self.std = features.std(axis=0)
+        # a constant feature carries no information, and would divide by zero
+        self.std[self.std == 0] = 1
+        self.points = np.ascontiguousarray(self.standardize(features), dtype=np.float32)
+        self.squared_norms = (self.points ** 2).sum(axis=1)
+
+    @classmethod
+    def from_records(cls, genres):
+        names = [genre["name"] for genre in genres]
+        uris = [genre["uri"] for genre in genres]
+        features = [[genre[feature_name] for feature_name in FEATURE_NAMES] for genre in genres]
+
+        return cls(names, uris, features)
+
+    def __len__(self):
+        return len(self.names)
+
+    def standardize(self, features):
+        return (np.asarray(features, dtype=np.float64) - self.mean) / self.std
+
+    # Returns the k genres closest to features (ordered as FEATURE_NAMES), closest first,
+    # as a list of { "name", "uri", "distance" }
+    def nearest(self, features, k=10):
+        k = max(0, min(k, len(self)))
+        if k == 0:
+            return []
+
+        query = self.standardize(features).astype(np.float32)
+        # |p - q|^2 = |p|^2 - 2 p.q + |q|^2
+        distances = self.squared_norms - 2 * self.points.dot(query) + query.dot(query)
+        closest = np.argpartition(distances, k - 1)[:k]
+        closest = closest[np.argsort(distances[closest])]
+
+        return [{
+            "name" : self.names[i],
+            "uri" : self.uris[i],
+            # rounding errors can make the distance to an exact match slightly negative
+            "distance" : float(np.sqrt(max(distances[i], 0))),
+        } for i in closest.tolist()]
+
+_index = None
+_index_lock = threading.Lock()
+
+# The index over the genre table, built the first time it is needed
+def get_genre_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                table = genre_table.get_genre_table()
+                columns = [table.feature_names.index(feature_name) for feature_name in FEATURE_NAMES]
+                _index = GenreIndex(table.names, table.uris, table.features[:, columns])
+
+    return _index
@@ -0,0 +1,78 @@
+import os
+import json
+import threading
+
+import artifacts
+
+# The genre table (data/data_genres_average_features.json) in a binary form that is fast to load
+#   genre_features.npy  float32 matrix with one row per genre and one column per feature
+#   genre_names.json    the genres' names and uris, the feature names and a version of the table
+# The feature matrix is memory mapped read only, so loading it doesn't parse anything and
+# every worker process on the machine shares the same pages
+# Both files are built from the JSON by scripts/build_genre_table.py
+# numpy is only imported once the table is loaded, so reading its version stays cheap
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+FEATURES_FILE = os.path.join(DATA_DIR, "genre_features.npy")
+NAMES_FILE = os.path.join(DATA_DIR, "genre_names.json")
+
+class GenreTable():
+    def __init__(self, names, uris, feature_names, features, version=None):
+        self.names = names
+        self.uris = uris
+        self.feature_names = feature_names
+        self.features = features
+        self.version = version
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def load(cls, features_file=FEATURES_FILE, names_file=NAMES_FILE):
+        import numpy as np
+        with open(names_file, "r") as f:
+            table = json.loads(f.read())
+        features = np.load(features_file, mmap_mode="r")
+
+        return cls(table["names"], table["uris"], table["feature_names"], features, version=table.get("version"))
+
+    # The table as the list of genre dictionaries the front end reads
+    def to_records(self):
+        import numpy as np
+        # the shortest string that identifies each float32, as Library.to_records does, rather
+        # than the float32's exact (and much longer) decimal expansion
+        features = self.features.astype(str).astype(np.float64).tolist()
+        records = []
+        for name, uri, values in zip(self.names, self.uris, features):
+            record = { "name" : name }
+            record.update(zip(self.feature_names, values))
+            record["uri"] = uri
+            records.append(record)
+
+        return records
+
+    # Writes the table as JSON, with compressed copies for /data to serve
+    def write_json(self, file_name):
+        artifacts.write_json(file_name, self.to_records())
+
+_table = None
+_table_lock = threading.Lock()
+_version = None
+
+def get_genre_table():
+    global _table
+    if _table is None:
+        with _table_lock:
+            if _table is None:
+                _table = GenreTable.load()
+
+    return _table
+
+# The version of the table, without loading it
+def get_version():
+    global _version
+    if _version is None:
+        with open(NAMES_FILE, "r") as f:
+            _version = json.loads(f.read()).get("version")
+
+    return _version
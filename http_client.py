@@ -0,0 +1,126 @@
+import os
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import rate_limit
+
+# Shared HTTP client for every call we make to Spotify (Web API and Accounts service)
+# A single requests.Session keeps TCP + TLS connections alive between calls so that
+# paginated scrapes reuse a handful of warm connections instead of handshaking per page
+#
+# Every request to Spotify also goes through a process wide rate limiter (see rate_limit.py),
+# and requests that are rate limited (429), fail with a 502 / 503 / 504 or can't connect are
+# retried with backoff, up to MAX_RETRIES times. Since spotipy is given this session too,
+# everything the app and the Lambda send to Spotify shares the one limiter
+# Only idempotent requests are retried: a POST such as exchanging an authorization code for a
+# token may have gone through even though its response didn't arrive, and the code can only be
+# used once. A 429 whose Retry-After is longer than rate_limit.MAX_DELAY is returned right away
+# rather than holding the request for minutes
+#
+# The pool and timeouts can be tuned with environment variables
+# SPOTIFY_POOL_SIZE is the number of connections kept alive per host
+# SPOTIFY_CONNECT_TIMEOUT and SPOTIFY_READ_TIMEOUT are in seconds
+POOL_SIZE = int(os.environ.get("SPOTIFY_POOL_SIZE", 16))
+CONNECT_TIMEOUT = float(os.environ.get("SPOTIFY_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = float(os.environ.get("SPOTIFY_READ_TIMEOUT", 30))
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+MAX_RETRIES = int(os.environ.get("SPOTIFY_MAX_RETRIES", 10))
+RETRY_STATUSES = [502, 503, 504]
+RETRY_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+
+_session = None
+_session_lock = threading.Lock()
+_limiter = None
+_limiter_lock = threading.Lock()
+
+class RateLimitedSession(requests.Session):
+    def __init__(self, limiter, max_retries=MAX_RETRIES):
+        super().__init__()
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    def request(self, method, url, *args, **kwargs):
+        if not urlparse(url).netloc.endswith("spotify.com"):
+            return super().request(method, url, *args, **kwargs)
+
+        max_retries = self.max_retries if method.upper() in RETRY_METHODS else 0
+        for attempt in range(max_retries + 1):
+            last_attempt = attempt == max_retries
+            endpoint = self.limiter.acquire(url)
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.limiter.release(endpoint, error=True)
+                if last_attempt:
+                    raise
+                delay = rate_limit.get_backoff(attempt)
+                logging.warning("{} {} failed ({}), retrying in {:.1f} seconds.".format(method, endpoint, e, delay))
+            except Exception:
+                self.limiter.release(endpoint, error=True)
+                raise
+            else:
+                if response.status_code == 429:
+                    retry_after = rate_limit.parse_retry_after(response.headers.get("Retry-After"))
+                    too_long = retry_after is not None and retry_after > rate_limit.MAX_DELAY
+                    if retry_after is not None:
+                        retry_after = min(retry_after, rate_limit.MAX_DELAY)
+                    self.limiter.release(endpoint, throttled=True, retry_after=retry_after)
+                    if too_long:
+                        return response
+                    delay = rate_limit.get_backoff(attempt, retry_after=retry_after)
+                elif response.status_code in RETRY_STATUSES:
+                    self.limiter.release(endpoint, error=True)
+                    delay = rate_limit.get_backoff(attempt)
+                else:
+                    self.limiter.release(endpoint)
+                    return response
+
+                if last_attempt:
+                    return response
+                logging.warning("{} {} returned {}, retrying in {:.1f} seconds.".format(method, endpoint, response.status_code, delay))
+
+            self.limiter.record_retry(endpoint)
+            time.sleep(delay)
+
+# Returns the process wide rate limiter
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = rate_limit.RateLimiter()
+
+    return _limiter
+
+def create_session(pool_size=POOL_SIZE):
+    session = RateLimitedSession(get_limiter())
+    # pool_connections is the number of hosts to keep pools for
+    # (api.spotify.com and accounts.spotify.com), pool_maxsize the connections per host
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+# Returns the process wide session, creating it on first use
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+
+    return _session
+
+def get(url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    return get_session().get(url, **kwargs)
+
+def post(url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    return get_session().post(url, **kwargs)
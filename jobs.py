@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import api_call
+import artifacts
+import cache
+
+# Background scrape jobs
+# /viz enqueues a scrape here and returns right away instead of holding a worker for the
+# whole scrape. Each job writes its progress to DATA_FOLDER/<user_id>/status.json so that
+# whichever worker process answers /status can read it. The "message" field uses the same
+# stages that scrape_db.scrape_library writes to DynamoDB ("Scraping library",
+# "Scraping song features", "Scraping artist genres", ..., "Done")
+
+#
+# Each worker process has its own job runner, so two workers (or two tabs answered by different
+# workers) could otherwise both start a scrape for the same user. Two lock files in the user's
+# folder coordinate them:
+#   status.lock  held briefly while deciding whether to start a scrape, so that only one worker
+#                decides at a time and the next one sees the status the first one wrote
+#   scrape.lock  held for as long as a scrape runs, with the process id of the scraping worker
+#                written in it, so that any worker can tell whether a scrape is in flight (even one
+#                whose status hasn't been updated in a while) by reading it, without taking the lock
+# A request that finds a scrape in flight just reports its status, i.e. it waits for it
+
+# Number of scrapes that can run at once in this process
+MAX_WORKERS = int(os.environ.get("SCRAPE_JOB_WORKERS", 2))
+# A queued / running status that hasn't been updated in this many seconds belongs to a
+# job that died with its process (e.g. a worker restart) and can be started again
+STALE_AFTER = int(os.environ.get("SCRAPE_JOB_STALE_AFTER", 15 * 60))
+# Scraped data older than this many seconds is refreshed in the background the next time
+# the user visits /viz, while the data we already have keeps being served
+REFRESH_AFTER = int(os.environ.get("LIBRARY_REFRESH_AFTER", 60 * 60))
+# Seconds a job waits for a scrape of the same user in another process to finish before it
+# leaves the scrape to that process
+SCRAPE_LOCK_TIMEOUT = 10
+
+QUEUED = "queued"
+RUNNING = "running"
+REFRESHING = "refreshing"
+DONE = "done"
+FAILED = "failed"
+# States in which the user's data can be shown
+READY_STATES = [DONE, REFRESHING]
+
+def get_status_file(user_id):
+    return os.path.join(api_call.get_user_folder(user_id), "status.json")
+
+def write_status(user_id, state, message, error=None):
+    status = {
+        "user_id" : user_id,
+        "state" : state,
+        "message" : message,
+        "updated" : time.time(),
+    }
+    if error is not None:
+        status["error"] = error
+
+    status_file = get_status_file(user_id)
+    os.makedirs(os.path.dirname(status_file), exist_ok=True)
+    # written then renamed, so readers never see a half written file
+    artifacts.write_atomic(status_file, json.dumps(status).encode("utf-8"))
+
+    return status
+
+def read_status(user_id):
+    try:
+        with open(get_status_file(user_id), "r") as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        # data scraped before scrape jobs existed has no status file
+        if api_call.is_cached(user_id):
+            return { "user_id" : user_id, "state" : DONE, "message" : "Done" }
+        return None
+
+# An exclusive lock on a file in a user's folder, shared by every process (flock)
+# Locks are released when the file is closed, so a worker that dies never leaves one behind
+class UserLock():
+    def __init__(self, user_id, name):
+        self.path = os.path.join(api_call.get_user_folder(user_id), name)
+        self.fd = None
+
+    # Returns whether the lock was taken; without blocking, False if another holder has it,
+    # and with a timeout, False if another holder still has it after that many seconds
+    def acquire(self, blocking=True, timeout=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX if blocking and deadline is None else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if not blocking or time.monotonic() >= deadline:
+                        os.close(fd)
+                        return False
+                    time.sleep(0.1)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+def get_scrape_lock_file(user_id):
+    return os.path.join(api_call.get_user_folder(user_id), "scrape.lock")
+
+# The user's scrape lock, with the id of the process holding it written in the lock file
+class ScrapeLock(UserLock):
+    def __init__(self, user_id):
+        super().__init__(user_id, "scrape.lock")
+
+    def acquire(self, blocking=True, timeout=None):
+        if not super().acquire(blocking=blocking, timeout=timeout):
+            return False
+
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, str(os.getpid()).encode("utf-8"), 0)
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            # emptied before the lock is released, so the next holder's id is never overwritten
+            os.ftruncate(self.fd, 0)
+        super().release()
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it exists, but belongs to another user
+        return True
+
+    return True
+
+# Returns whether a scrape for this user is running in any process
+# This only reads the lock file: taking the lock to test it, even briefly, would make a job
+# that starts at the same moment think that another process is scraping and give up
+# A process that died while scraping leaves its id behind, but is no longer alive
+def is_scraping(user_id):
+    try:
+        with open(get_scrape_lock_file(user_id), "r") as f:
+            pid = int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return False
+
+    return is_process_alive(pid)
+
+def is_stale(status):
+    return status["state"] in [QUEUED, RUNNING, REFRESHING] and time.time() - status.get("updated", 0) > STALE_AFTER
+
+def needs_refresh(status):
+    return status["state"] == DONE and time.time() - status.get("updated", 0) > REFRESH_AFTER
+
+# Runs scrape jobs on a thread pool inside this process, so no AWS services are needed
+class LocalJobRunner():
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scrape")
+        self.lock = threading.Lock()
+        # user_id -> Future of the job running for that user in this process
+        self.jobs = {}
+
+    def is_running(self, user_id):
+        with self.lock:
+            return user_id in self.jobs
+
+    # With refresh, the user's cached data is brought up to date rather than scraped from scratch
+    def submit(self, user_id, token, spotipy_session, refresh=False):
+        with self.lock:
+            if user_id in self.jobs:
+                return self.jobs[user_id]
+
+            if refresh:
+                write_status(user_id, REFRESHING, "Refreshing library")
+            else:
+                write_status(user_id, QUEUED, "Queued")
+            future = self.executor.submit(self.run, user_id, token, spotipy_session, refresh)
+            self.jobs[user_id] = future
+
+        future.add_done_callback(lambda future: self.finish(user_id))
+        return future
+
+    def finish(self, user_id):
+        with self.lock:
+            self.jobs.pop(user_id, None)
+
+    def scrape(self, user_id, token, spotipy_session, refresh=False):
+        def progress(message):
+            write_status(user_id, REFRESHING if refresh else RUNNING, message)
+            # what has been written so far counts towards the size of the user data cache
+            get_user_data_cache().record_write(user_id)
+
+        try:
+            data = api_call.scrape_data(token, spotipy_session, user_id, progress=progress, refresh=refresh)
+            # written here so that /data only ever serves them, and the front end doesn't have
+            # to work them out
+            api_call.ensure_library_umbrellas(user_id, library=data["library"])
+        except Exception as e:
+            logging.exception("Scrape job for {} failed.".format(user_id))
+            if refresh:
+                # the data we already have is still good to show
+                write_status(user_id, DONE, "Done", error=str(e))
+            else:
+                write_status(user_id, FAILED, "Error scraping library", error=str(e))
+            return
+
+        write_status(user_id, DONE, "Done")
+
+    def run(self, user_id, token, spotipy_session, refresh=False):
+        lock = ScrapeLock(user_id)
+        if not lock.acquire(timeout=SCRAPE_LOCK_TIMEOUT):
+            # another worker is in the middle of scraping this user, and writes the status over
+            # ours as it goes, up to its final "done" or "failed"
+            logging.info("Scrape for {} is already running in another process.".format(user_id))
+            return
+
+        try:
+            self.scrape(user_id, token, spotipy_session, refresh=refresh)
+        finally:
+            lock.release()
+            get_user_data_cache().record_write(user_id)
+
+_runner = None
+_runner_lock = threading.Lock()
+_user_data_cache = None
+
+def get_runner():
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                _runner = LocalJobRunner()
+
+    return _runner
+
+# The per user folders that scrape jobs write to, bounded in size and age
+# Folders with a scrape queued in this process, or running in any process, are never evicted
+def get_user_data_cache():
+    global _user_data_cache
+    if _user_data_cache is None:
+        runner = get_runner()
+        with _runner_lock:
+            if _user_data_cache is None:
+                _user_data_cache = cache.FolderCache(api_call.DATA_FOLDER, cache.USER_DATA_MAX_BYTES,
+                                                     ttl=cache.USER_DATA_TTL, path=cache.CACHE_DB,
+                                                     in_use=lambda user_id: runner.is_running(user_id) or is_scraping(user_id))
+
+    return _user_data_cache
+
+# Returns the scrape status for this user, starting a scrape job first if the user has
+# no data yet, their last scrape failed, or their last scrape was abandoned
+# Data scraped before the files derived from it existed (or before the genre table changed) is
+# run through a scrape job too, which reads it from the cache and writes those files
+# Data that is getting old is refreshed in the background
+# A scrape that is queued or running, in this process or another, is never started twice
+def ensure_scraped(user_id, token, spotipy_session):
+    runner = get_runner()
+    # this also deletes the user's data if it has expired, in which case it is scraped again
+    get_user_data_cache().lookup(user_id)
+    with UserLock(user_id, "status.lock"):
+        status = read_status(user_id)
+        if status is not None and status["state"] != FAILED and (runner.is_running(user_id) or is_scraping(user_id)):
+            return status
+
+        if status is None or status["state"] == FAILED or is_stale(status) or \
+           (status["state"] == DONE and api_call.needs_library_umbrellas(user_id)):
+            runner.submit(user_id, token, spotipy_session)
+            status = read_status(user_id)
+        elif needs_refresh(status):
+            runner.submit(user_id, token, spotipy_session, refresh=True)
+            status = read_status(user_id)
+
+    return status
@@ -0,0 +1,239 @@
+import numpy as np
+
+# A columnar, compact in-memory representation of a list of tracks
+#
+# The scrapers used to build a list of dictionaries, one per track, each repeating the same
+# keys. Here every key is a column instead:
+#   numbers          -> a NumPy array (float32 for audio features, int32 for counts like popularity)
+#   strings          -> int32 codes into a string table shared by every column (names, uris, dates...)
+#   lists of strings -> an offsets array plus flat int32 codes (genres, artist names...)
+#   lists of dicts   -> an offsets array plus flat int32 codes per dictionary key (artists as {name, id})
+# Anything else (missing keys, None, mixed types) is kept as a plain Python list
+#
+# Conversion to and from the list of dictionaries format is loss-free: float columns are only
+# stored as float32 if every value survives the round trip (Spotify's features have few enough
+# significant digits that they do), otherwise they are stored as float64
+
+NUMBER = "number"
+STRING = "string"
+STRING_LIST = "string_list"
+DICT_LIST = "dict_list"
+OBJECT = "object"
+
+# Marks a key that is missing from a record in an object column
+MISSING = object()
+
+def is_number(value):
+    return isinstance(value, (int, float, np.number)) and not isinstance(value, (bool, np.bool_))
+
+def is_integer(value):
+    return isinstance(value, (int, np.integer)) and not isinstance(value, (bool, np.bool_))
+
+def float32_round_trips(values):
+    as_float64 = np.asarray(values, dtype=np.float64)
+    as_float32 = as_float64.astype(np.float32)
+    # astype(str) gives the shortest string that identifies each float32, which is how
+    # to_records converts them back
+    return np.array_equal(as_float32.astype(str).astype(np.float64), as_float64)
+
+def classify(values):
+    if all(is_number(value) for value in values):
+        return NUMBER
+    if all(isinstance(value, str) for value in values):
+        return STRING
+    if all(isinstance(value, list) for value in values):
+        items = [item for value in values for item in value]
+        if all(isinstance(item, str) for item in items):
+            return STRING_LIST
+        if all(isinstance(item, dict) for item in items):
+            # every dictionary needs the same string valued keys
+            item_keys = [list(item.keys()) for item in items]
+            if all(keys == item_keys[0] for keys in item_keys) and \
+               all(isinstance(v, str) for item in items for v in item.values()):
+                return DICT_LIST
+
+    return OBJECT
+
+class StringTable():
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def encode(self, values):
+        codes = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            code = self.codes.get(value)
+            if code is None:
+                code = len(self.strings)
+                self.codes[value] = code
+                self.strings.append(value)
+            codes[i] = code
+
+        return codes
+
+    def decode(self, codes):
+        strings = self.strings
+        return [strings[code] for code in codes.tolist()]
+
+    def nbytes(self):
+        return sum(len(s.encode("utf-8")) for s in self.strings)
+
+class Library():
+    def __init__(self, num_tracks):
+        self.num_tracks = num_tracks
+        self.strings = StringTable()
+        # key -> (kind, column data), in the key order of the records
+        self.columns = {}
+
+    def __len__(self):
+        return self.num_tracks
+
+    def keys(self):
+        return list(self.columns.keys())
+
+    # Build a library from a dictionary of key -> list (or 1D array) of values, one per track
+    @classmethod
+    def from_columns(cls, columns):
+        lengths = set(len(values) for values in columns.values())
+        if len(lengths) > 1:
+            raise ValueError(f"Columns have different lengths: {sorted(lengths)}")
+
+        library = cls(lengths.pop() if lengths else 0)
+        for key, values in columns.items():
+            library.add_column(key, values)
+
+        return library
+
+    # Build a library from a list of track dictionaries
+    @classmethod
+    def from_records(cls, records):
+        keys = {}
+        for record in records:
+            for key in record:
+                keys[key] = None
+
+        columns = { key : [record.get(key, MISSING) for record in records] for key in keys }
+        library = cls.from_columns(columns)
+        library.num_tracks = len(records)
+
+        return library
+
+    def add_column(self, key, values):
+        if isinstance(values, np.ndarray) and values.dtype.kind in "iuf":
+            values = values.tolist()
+        else:
+            values = list(values)
+
+        if any(value is MISSING for value in values):
+            kind = OBJECT
+        else:
+            kind = classify(values)
+
+        if kind == NUMBER:
+            num_integers = sum(is_integer(value) for value in values)
+            if num_integers == len(values):
+                data = np.asarray(values, dtype=np.int64)
+                if len(data) == 0 or (data.min() >= np.iinfo(np.int32).min and data.max() <= np.iinfo(np.int32).max):
+                    data = data.astype(np.int32)
+            elif num_integers > 0:
+                # a mix of ints and floats can't be stored in one array without turning 1 into 1.0
+                kind = OBJECT
+                data = values
+            elif float32_round_trips(values):
+                data = np.asarray(values, dtype=np.float32)
+            else:
+                data = np.asarray(values, dtype=np.float64)
+        elif kind == STRING:
+            data = self.strings.encode(values)
+        elif kind == STRING_LIST:
+            offsets = np.cumsum([0] + [len(value) for value in values], dtype=np.int64)
+            data = (offsets, self.strings.encode([item for value in values for item in value]))
+        elif kind == DICT_LIST:
+            offsets = np.cumsum([0] + [len(value) for value in values], dtype=np.int64)
+            items = [item for value in values for item in value]
+            item_keys = list(items[0].keys()) if items else []
+            data = (offsets, { item_key : self.strings.encode([item[item_key] for item in items])
+                               for item_key in item_keys })
+        else:
+            data = values
+
+        self.columns[key] = (kind, data)
+
+    # Returns the values of a column as a list with one entry per track
+    def column(self, key):
+        kind, data = self.columns[key]
+        if kind == NUMBER:
+            if data.dtype == np.float32:
+                return data.astype(str).astype(np.float64).tolist()
+            return data.tolist()
+        elif kind == STRING:
+            return self.strings.decode(data)
+        elif kind == STRING_LIST:
+            offsets, codes = data
+            flat = self.strings.decode(codes)
+            return [flat[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+        elif kind == DICT_LIST:
+            offsets, item_codes = data
+            flat = { item_key : self.strings.decode(codes) for item_key, codes in item_codes.items() }
+            num_items = int(offsets[-1])
+            items = [{ item_key : flat[item_key][i] for item_key in flat } for i in range(num_items)]
+            return [items[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+        else:
+            return list(data)
+
+    # Convert back to a list of track dictionaries, identical to the ones the library was built from
+    def to_records(self):
+        columns = { key : self.column(key) for key in self.columns }
+        records = [{} for _ in range(self.num_tracks)]
+        for key, values in columns.items():
+            for record, value in zip(records, values):
+                if value is not MISSING:
+                    record[key] = value
+
+        return records
+
+    # Returns a (num_tracks, len(feature_names)) float32 matrix of numeric columns
+    # A column of ints and floats mixed (e.g. 1 in some tracks and 0.5 in others after a JSON
+    # round trip) is kept as an object column so that it converts back as it was, but is a
+    # numeric column as far as its features go
+    def features(self, feature_names):
+        matrix = np.empty((self.num_tracks, len(feature_names)), dtype=np.float32)
+        for i, feature_name in enumerate(feature_names):
+            kind, data = self.columns[feature_name]
+            if kind == OBJECT and all(is_number(value) for value in data):
+                data = np.asarray(data, dtype=np.float64)
+            elif kind != NUMBER:
+                raise ValueError(f"'{feature_name}' is not a numeric column")
+            matrix[:, i] = data
+
+        return matrix
+
+    def mean_features(self, feature_names):
+        return self.features(feature_names).mean(axis=0, dtype=np.float64)
+
+    # Number of times each string occurs in a list column, e.g. the genre counts of the library
+    def list_counts(self, key):
+        kind, data = self.columns[key]
+        if kind != STRING_LIST:
+            raise ValueError(f"'{key}' is not a list of strings column")
+        offsets, codes = data
+        counts = np.bincount(codes, minlength=len(self.strings))
+        present = np.nonzero(counts)[0]
+
+        return dict(zip(self.strings.decode(present), counts[present].tolist()))
+
+    # Approximate number of bytes used by the columns and string table
+    def nbytes(self):
+        total = self.strings.nbytes()
+        for kind, data in self.columns.values():
+            if kind in [NUMBER, STRING]:
+                total += data.nbytes
+            elif kind == STRING_LIST:
+                total += data[0].nbytes + data[1].nbytes
+            elif kind == DICT_LIST:
+                total += data[0].nbytes + sum(codes.nbytes for codes in data[1].values())
+
+        return total
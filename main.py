@@ -1,4 +1,4 @@
-from flask import Flask, request, redirect, render_template, url_for, send_from_directory, session
+from flask import Flask, request, redirect, render_template, url_for, send_from_directory, session, jsonify, abort
 import requests
 from urllib.parse import quote
 import json
@@ -6,8 +6,14 @@ import datetime
 import os
 import logging
 from pprint import pprint
-import shutil
-import auth, api_call
+import threading
+import mimetypes
+import artifacts, auth, api_call, cache, genre_table, http_client, jobs
+try:
+    from werkzeug.utils import safe_join
+except ImportError:
+    # Werkzeug < 2.0
+    from werkzeug.security import safe_join
 
 app = Flask(__name__)
 app.secret_key = b"dfsdfa"
@@ -17,13 +23,30 @@ logging.basicConfig(
 )
 logger = logging.getLogger("")
 
-# ensure that the file /tmp/data/data_genres_average_features.json exists
+if not os.path.exists("/tmp/data"):
+    os.makedirs("/tmp/data")
+
+# Files in /tmp/data that are the same for every user
+# They are cached by browsers for good, so their URLs are versioned
+SHARED_DATA_FILES = ["data_genres_average_features.json"]
+genres_json_lock = threading.Lock()
+
+# Writes the genre table JSON for the front end from the binary table, the first time it is
+# requested rather than on every start up
 # TODO: Pull from remote URL
-if not os.path.exists("/tmp/data/data_genres_average_features.json"):
-    if not os.path.exists("/tmp/data"):
-        os.makedirs("/tmp/data")
-    
-    shutil.copyfile("data/data_genres_average_features.json", "/tmp/data/data_genres_average_features.json")
+def ensure_genres_json():
+    version = genre_table.get_version()
+    file_name = "/tmp/data/data_genres_average_features.json"
+    # the file may have been written from a previous version of the table
+    version_file = file_name + ".version"
+    with genres_json_lock:
+        if os.path.exists(version_file):
+            with open(version_file, "r") as f:
+                if f.read() == version:
+                    return
+
+        genre_table.get_genre_table().write_json(file_name)
+        artifacts.write_atomic(version_file, version.encode("utf-8"))
 
 # the scope of access we are requesting from the user
 # we ask to read all playlists, library songs, recently played, and top artists / tracks
@@ -80,6 +103,22 @@ def construct_query(params):
     query = "&".join(query_args)
     return query
 
+# Returns the profile of the user whose access token this is
+# The profile is kept in the session, together with the user's id and which token it belongs
+# to, so a user's repeat page loads don't have to ask Spotify who they are. A new token (after
+# /refresh or a new login) is looked up again, via api_call's in-memory cache of profiles
+def get_user_profile(user_auth_token):
+    token_key = api_call.get_token_key(user_auth_token)
+    if session.get("profile_token") == token_key and "profile_data" in session:
+        return session["profile_data"]
+
+    profile_data = api_call.get_profile_data(user_auth_token)
+    session["profile_data"] = profile_data
+    session["user_id"] = profile_data["id"]
+    session["profile_token"] = token_key
+
+    return profile_data
+
 # Checks that the user has logged in by checking if
 # we have API access to their account by looking at
 # browser cookies
@@ -193,7 +232,7 @@ def get_access_and_refresh_token(grant_type, code):
     else:
         raise Exception
 
-    token_post_response = requests.post(access_token_endpoint, data=parameters)
+    token_post_response = http_client.post(access_token_endpoint, data=parameters)
     # If the POST response is okay, we expect the following data to be returned in a JSON object
     # access_token	string	An access token that can be provided in subsequent calls, for example to Spotify Web API services.
     # token_type	string	How the access token may be used: always “Bearer”.
@@ -282,28 +321,70 @@ def viz():
     if response:
         return response
     else:
-        spotipy_session = auth.create_spotipy_client_session(CLIENT_ID, CLIENT_SECRET)
+        spotipy_session = auth.get_spotipy_client_session(CLIENT_ID, CLIENT_SECRET)
 
         user_auth_token = request.cookies.get("SpotifyUserAccessToken")
         
-        profile_data = api_call.get_profile_data(user_auth_token)
+        profile_data = get_user_profile(user_auth_token)
         user_id = profile_data['id']
 
-        logging.info("Scraping user data for {}...".format(user_id))
-        # Scrape all of the relevant data for this user
-        scrape = api_call.scrape_data(user_auth_token, spotipy_session, user_id)    
+        # Start a background scrape of all of the relevant data for this user if we
+        # don't have it yet, rather than scraping inside this request
+        status = jobs.ensure_scraped(user_id, user_auth_token, spotipy_session)
 
-        # Combine profile and playlist data to display
-        profile_data = scrape["profile"]
-
-        user_basename = "static/data/{}".format(profile_data['id'])
-        
         if LOCAL_PORT:
             base_url = APP_URL + ":" + LOCAL_PORT
         else:
             base_url = APP_URL
 
-        return render_template("viz.html", user_id=profile_data['id'], base_url=base_url)
+        # Until the scrape is done, show a page that polls /status and reloads when it finishes
+        if status["state"] not in jobs.READY_STATES:
+            logging.info("Scraping user data for {}...".format(user_id))
+            return render_template("loading.html", user_id=user_id, base_url=base_url, message=status["message"])
+
+        return render_template("viz.html", user_id=user_id, base_url=base_url, genres_version=genre_table.get_version())
+
+# Reports the progress of a user's scrape job as JSON
+# e.g. { "user_id" : ..., "state" : "running", "message" : "Scraping song features", "updated" : ... }
+@app.route("/status/<user_id>")
+def status(user_id):
+    status = jobs.read_status(user_id)
+    if status is None:
+        return jsonify({ "user_id" : user_id, "state" : None, "message" : "No scrape found" }), 404
+
+    return jsonify(status)
+
+# The k genres closest to a user's library as a whole, or to one of its tracks
+# e.g. /genres/nearest/<user_id>?k=10 or /genres/nearest/<user_id>?track=spotify:track:...
+@app.route("/genres/nearest/<user_id>")
+def nearest_genres(user_id):
+    # imported here since it needs numpy, which the other routes don't
+    import genre_index
+    k = request.args.get("k", 10, type=int)
+    track_uri = request.args.get("track")
+
+    library = api_call.read_library(user_id)
+    if library is None or len(library) == 0:
+        return jsonify({ "user_id" : user_id, "message" : "No library found" }), 404
+
+    if track_uri:
+        uris = library.column("uri")
+        if track_uri not in uris:
+            return jsonify({ "user_id" : user_id, "message" : "Track not in library" }), 404
+        features = library.features(genre_index.FEATURE_NAMES)[uris.index(track_uri)]
+    else:
+        features = library.mean_features(genre_index.FEATURE_NAMES)
+
+    return jsonify({
+        "user_id" : user_id,
+        "track" : track_uri,
+        "genres" : genre_index.get_genre_index().nearest(features, k=k),
+    })
+
+# Request, throttle and retry counts per Spotify endpoint, and the rate limiter's current concurrency
+@app.route("/spotify_stats")
+def spotify_stats():
+    return jsonify(http_client.get_limiter().stats())
 
 @app.route("/playlists")
 def playlists():
@@ -312,7 +393,7 @@ def playlists():
         return response
     else:
         user_auth_token = request.cookies.get("SpotifyUserAccessToken")
-        profile_data = api_call.get_profile_data(user_auth_token)
+        profile_data = get_user_profile(user_auth_token)
         playlists = api_call.get_user_playlists(user_auth_token, profile_data['id'])
         pprint(playlists)
         return """
@@ -322,7 +403,56 @@ def playlists():
 @app.route('/data/<path:filepath>')
 def data(filepath):
     # print(filepath)
-    return send_from_directory('/tmp/data', filepath)
+    # the path is checked before anything on disk is, so that e.g. ../ can't reach outside /tmp/data
+    file_name = safe_join('/tmp/data', filepath)
+    if file_name is None:
+        abort(404)
+
+    shared = "/" not in filepath
+    if shared:
+        if filepath not in SHARED_DATA_FILES:
+            abort(404)
+        ensure_genres_json()
+    else:
+        # per user data lives in /tmp/data/<user_id>/
+        user_id = filepath.partition("/")[0]
+        jobs.get_user_data_cache().touch(user_id)
+
+    # send a precompressed copy of the file if the client accepts one
+    encoding, suffix = artifacts.choose_encoding(file_name, request.accept_encodings)
+    etag = artifacts.get_etag(file_name, encoding)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = send_from_directory('/tmp/data', filepath + suffix, mimetype=mimetypes.guess_type(filepath)[0])
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+
+    if etag is not None:
+        response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    if shared and request.args.get("v") == genre_table.get_version():
+        # a URL with the current version (?v=<genre table version>) always has the same content;
+        # any other version could be stale or made up, so it isn't pinned in browser caches
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    elif shared:
+        # without a version, browsers have to check the ETag for a new one
+        response.headers["Cache-Control"] = "public, no-cache"
+    else:
+        # a user's data changes whenever it is refreshed, so browsers have to check for a new version
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+# Hit, miss and eviction counts of the per user data folders, the shared lookup caches and
+# the profile cache
+@app.route("/cache_stats")
+def cache_stats():
+    return jsonify({
+        "user_data" : jobs.get_user_data_cache().stats(),
+        "audio_features" : cache.get_audio_features_cache().stats(),
+        "artist_genres" : cache.get_artist_genres_cache().stats(),
+        "profiles" : cache.get_profile_cache().stats(),
+    })
 
 if __name__ == "__main__":
     if LOCAL_PORT:
@@ -0,0 +1,157 @@
+import os
+import time
+import random
+import threading
+import collections
+from urllib.parse import urlparse
+
+# Process wide limiter for requests to Spotify
+# Every request first takes a token from a token bucket, which caps the sustained request rate
+# (RATE per second, with bursts of up to BURST), and then a slot from a concurrency limit that
+# adapts to how Spotify responds: it grows by one after every `limit` successful requests in a
+# row and halves on every 429 (additive increase, multiplicative decrease)
+# A 429's Retry-After pauses every request in the process, not just the one that got it, since
+# Spotify rate limits the app as a whole
+RATE = float(os.environ.get("SPOTIFY_RATE_LIMIT", 20))
+BURST = int(os.environ.get("SPOTIFY_RATE_BURST", 40))
+INITIAL_CONCURRENCY = int(os.environ.get("SPOTIFY_CONCURRENCY", 8))
+MAX_CONCURRENCY = int(os.environ.get("SPOTIFY_MAX_CONCURRENCY", 32))
+MIN_CONCURRENCY = 1
+# The longest (seconds) that a retry waits, or that a Retry-After pauses requests for
+MAX_DELAY = float(os.environ.get("SPOTIFY_MAX_RETRY_DELAY", 30))
+
+class TokenBucket():
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Takes a token, waiting until there is one
+    # Tokens are reserved in the order callers arrive, so the bucket may go negative, and
+    # each caller sleeps for its share of the debt
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    # Drops any saved up tokens, so that requests resume at the steady rate rather than in a burst
+    def drain(self):
+        with self.lock:
+            self.tokens = min(self.tokens, 0)
+            self.updated = time.monotonic()
+
+class EndpointStats():
+    def __init__(self):
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.retries = 0
+        self.wait = 0.0
+
+    def to_dict(self):
+        return {
+            "requests" : self.requests,
+            "throttled" : self.throttled,
+            "errors" : self.errors,
+            "retries" : self.retries,
+            "wait" : round(self.wait, 3),
+        }
+
+class RateLimiter():
+    def __init__(self, rate=RATE, burst=BURST, concurrency=INITIAL_CONCURRENCY,
+                 min_concurrency=MIN_CONCURRENCY, max_concurrency=MAX_CONCURRENCY):
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        # time.monotonic() until which nothing is sent, after a Retry-After
+        self.paused_until = 0
+        self.condition = threading.Condition()
+        # endpoint (the URL's path) -> EndpointStats
+        self.endpoints = collections.defaultdict(EndpointStats)
+
+    # Waits for a token and a free slot, and returns the endpoint to pass to release
+    def acquire(self, url):
+        endpoint = urlparse(url).path
+        start = time.monotonic()
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                elif self.in_flight >= self.limit:
+                    self.condition.wait()
+                else:
+                    self.in_flight += 1
+                    break
+        self.bucket.acquire()
+
+        with self.condition:
+            stats = self.endpoints[endpoint]
+            stats.requests += 1
+            stats.wait += time.monotonic() - start
+
+        return endpoint
+
+    # Frees the slot taken by acquire
+    # throttled is whether Spotify answered with a 429, retry_after its Retry-After in seconds
+    def release(self, endpoint, throttled=False, retry_after=None, error=False):
+        with self.condition:
+            self.in_flight -= 1
+            stats = self.endpoints[endpoint]
+            if throttled:
+                stats.throttled += 1
+                self.successes = 0
+                self.limit = max(self.min_concurrency, self.limit // 2)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                    self.bucket.drain()
+            elif error:
+                stats.errors += 1
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+    def record_retry(self, endpoint):
+        with self.condition:
+            self.endpoints[endpoint].retries += 1
+
+    def stats(self):
+        with self.condition:
+            return {
+                "concurrency" : self.limit,
+                "in_flight" : self.in_flight,
+                "paused_for" : round(max(0, self.paused_until - time.monotonic()), 3),
+                "endpoints" : { endpoint : stats.to_dict() for endpoint, stats in self.endpoints.items() },
+            }
+
+# Seconds to wait before retry number attempt (counting from 0)
+# Retry-After is honoured, with up to a second of jitter on top so that the requests it paused
+# don't all retry at the same instant; otherwise the delay doubles with every attempt, with
+# "full jitter" (a random delay up to the doubled value) to spread retries out
+def get_backoff(attempt, retry_after=None, base=0.5, max_delay=MAX_DELAY):
+    if retry_after is not None:
+        return min(max_delay, retry_after + random.uniform(0, 1))
+
+    return random.uniform(0, min(max_delay, base * 2 ** attempt))
+
+# Parses a Retry-After header given in seconds, None if there is none
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
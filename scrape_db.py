@@ -1,10 +1,12 @@
 import json
-import zlib
 from db import DataBase
-import math
 import datetime
 import requests
 import logging
+from concurrent.futures import ThreadPoolExecutor
+import http_client
+import cache
+import compression
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -24,29 +26,22 @@ API_ENDPOINTS = {
 for key, value in API_ENDPOINTS.items():
     API_ENDPOINTS[key] = SPOTIFY_API_URL + value
 
-def get(endpoint, token, max_retries=10, delay=4):
+# Rate limiting and retries are handled by http_client, so anything but OK here is an error
+def get(endpoint, token):
     authorization_header = {"Authorization": "Bearer {}".format(token)}
     try:
         logger.info("GET: " + endpoint)
-        response = requests.get(endpoint, headers=authorization_header)
-    except requests.exceptions.ConnectionError as e:
-        response = {}
-        response.status_code = 429
-        logger.warn("Could not fulfill GET.\n" + e)
+        response = http_client.get(endpoint, headers=authorization_header)
+    except requests.exceptions.RequestException as e:
+        msg = "Could not fulfill GET {}: {}".format(endpoint, e)
+        logger.error(msg)
+        raise RuntimeError(msg)
     # If status is anything but OK, raise an error
     if response.status_code != 200:
-        if response.status_code == 429:
-            if max_retries > 0:
-                time.sleep(delay)
-                return get(endpoint, token, max_retries=max_retries - 1, delay=delay + 1)
-            else:
-                msg = "Connection refused after {} retries".format(max_retries)
-                logger.error(msg)
-                raise RuntimeError(msg)
         logger.error(response.reason)
         raise RuntimeError(response.reason)
     
-    return response	
+    return response
 
 def scrape_profile(token):
     key = "user_profile"
@@ -66,13 +61,18 @@ def generate_paginated_urls(endpoint, total, limit):
     
     return urls
 
-def scrape_paginated_data(endpoint, token, limit=None):
+def get_page(url, token):
+    return get(url, token).json()
+
+# Fetches the first page to learn the total number of items, then fetches every
+# remaining offset page. With max_workers > 1 the remaining pages are fetched
+# concurrently on a bounded thread pool; pages are always returned in offset order
+def scrape_paginated_data(endpoint, token, limit=None, max_workers=8):
     if limit:
         url = endpoint + f"?limit={limit}"
     else:
         url = endpoint
-    response = get(url, token)
-    page = response.json()
+    page = get_page(url, token)
 
     all_pages = [page]
     
@@ -81,11 +81,13 @@ def scrape_paginated_data(endpoint, token, limit=None):
         limit = page['limit']
 
     urls = generate_paginated_urls(endpoint, total, limit)
-    # try to perform all of these asynchronously
-    for i, url in enumerate(urls):
-        response = get(url, token)
-        page = response.json()
-        all_pages.append(page)
+    if max_workers > 1 and len(urls) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+            # map yields results in the order of urls, not completion order
+            all_pages += list(executor.map(lambda url: get_page(url, token), urls))
+    else:
+        for url in urls:
+            all_pages.append(get_page(url, token))
 
     return all_pages
     
@@ -141,43 +143,36 @@ def parse_features(features):
 
 # Gets audio features for every track id given
 # don't technically need the user's token to scrape these since they are publically available
+# Features are shared between users, so only the tracks missing from the cache are requested
 def scrape_audio_features(track_ids, token, limit=100):
     key = "audio_features"
     endpoint = API_ENDPOINTS[key]
-    total = len(track_ids)
-    urls = []
-    for i in range(int(total / limit) + 1):
-        low = i * limit
-        high = (i + 1) * limit
-        urls.append(endpoint + "?ids=" + ",".join(track_ids[low:high]))
-    
-    all_features = []
-    for url in urls:
-        response = get(url, token)
+
+    def fetch_features(ids):
+        response = get(endpoint + "?ids=" + ",".join(ids), token)
         track_features = response.json()['audio_features']
-        for features in track_features:
-            all_features.append(parse_features(features))
+        return [None if features is None else parse_features(features) for features in track_features]
+
+    all_features = cache.cached_lookup(track_ids, cache.get_audio_features_cache(), fetch_features, limit)
 
-    return all_features
+    # some tracks (e.g. local files) have no features
+    return [features if features is not None else {} for features in all_features]
 
+# Gets the genres of every artist id given
+# Each distinct artist is only requested once, and artists whose genres are already
+# in the shared cache aren't requested at all
 def scrape_genres(artist_ids, token, limit=50):
     key = "artists"
     endpoint = API_ENDPOINTS[key]
-    total = len(artist_ids)
-    urls = []
-    for i in range(int(total / limit) + 1):
-        low = i * limit
-        high = (i + 1) * limit
-        urls.append(endpoint + "?ids=" + ",".join(artist_ids[low:high]))
-    
-    all_genres = []
-    for url in urls:
-        response = get(url, token)
+
+    def fetch_genres(ids):
+        response = get(endpoint + "?ids=" + ",".join(ids), token)
         artists = response.json()['artists']
-        for artist in artists:
-            all_genres.append(artist['genres'])
+        return [None if artist is None else artist['genres'] for artist in artists]
 
-    return all_genres        
+    all_genres = cache.cached_lookup(artist_ids, cache.get_artist_genres_cache(), fetch_genres, limit)
+
+    return [genres if genres is not None else [] for genres in all_genres]
 
 def compile_library(tracks, audio_features, genres):
     # compile into data structure we want
@@ -191,36 +186,118 @@ def compile_library(tracks, audio_features, genres):
             genre_idx += 1
         track["genres"] = list(set(sum(track_genres, [])))
 
-def compress_data(data):
-    return zlib.compress(json.dumps(data).encode('utf-8'))
-
-def partition_and_compress_list(data_list):
-    # max size of a parition in KB
-    MAX_PARTITION_SIZE = 350
-    compressed = compress_data(data_list)
-    
-    data_size = compressed.__sizeof__()
-    data_size_kb = data_size / 1024
-
-    # DynamoDB has an item limit of 400 KB
-    # if we go beyond this, need to partition the data up into
-    # pieces and store those pieces separately
-    # Use 350 KB to keep a 50 KB overhead for database key sizes
-    # and changes in compression efficiency over different partitions
-    num_partitions = math.ceil(data_size_kb / MAX_PARTITION_SIZE)
-
-    total_items = len(data_list)
-    tracks_per_partition = math.ceil(total_items / num_partitions)
-    # need to split the data into multiple partitions and store them separately
+# Compressed with the codec named by compression.TRACK_CODEC unless another is given
+def compress_data(data, codec=None):
+    if codec is None:
+        codec = compression.get_codec()
+    return codec.compress(json.dumps(data).encode('utf-8'))
+
+# Reads data written by compress_data with any codec, or by plain zlib before there were codecs
+def decompress_data(data):
+    return json.loads(compression.decompress(data).decode('utf-8'))
+
+# DynamoDB has an item limit of 400 KB, which includes the names of the attributes and the
+# partition's key, so partitions are kept ITEM_OVERHEAD bytes below that
+MAX_ITEM_SIZE = 400 * 1024
+ITEM_OVERHEAD = 1024
+MAX_PARTITION_SIZE = MAX_ITEM_SIZE - ITEM_OVERHEAD
+# Bytes given to a partition's compressor between flushes, see PartitionCompressor
+SYNC_FLUSH_INTERVAL = 16 * 1024
+
+# Compresses a JSON list one item at a time, without ever going over a size budget
+# Until the partition gets close to the budget, items are added as long as the worst case size
+# of everything not yet flushed out of the compressor still fits, which needs no extra work
+# since the compressor is flushed every SYNC_FLUSH_INTERVAL bytes. Close to the budget, the
+# compressor is copied, the item added and flushed to learn the exact size, and the copy is
+# restored if the item didn't fit
+# Codecs whose compressor can't be copied (zstd) flush instead, and only add the item if its
+# worst case size fits, which leaves at most about one item's worth of the budget unused
+# The output is in the same format as compress_data, so decompress_data reads both
+class PartitionCompressor():
+    def __init__(self, max_size, codec):
+        self.max_size = max_size
+        self.codec = codec
+        self.compressor = codec.compressobj()
+        self.can_copy = hasattr(self.compressor, "copy")
+        self.chunks = [bytes([codec.header])]
+        self.size = 1
+        # bytes given to the compressor since it was last flushed
+        self.pending = 0
+        self.num_items = 0
+        self.write(b"[")
+
+    def write(self, data):
+        chunk = self.compressor.compress(data)
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        self.pending += len(data)
+
+    def flush(self):
+        chunk = self.compressor.flush()
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        self.pending = 0
+
+    # Upper bound on the size of the partition if it were finished after another extra bytes
+    def bound(self, extra):
+        # 1 for the closing bracket
+        return self.size + self.codec.bound(self.pending + extra + 1)
+
+    # Adds a JSON encoded item, unless that would take the partition over its budget
+    # Returns whether the item was added
+    def add(self, item):
+        # the same separator json.dumps uses
+        data = b", " + item if self.num_items else item
+        if self.bound(len(data)) > self.max_size and self.pending > 0 and not self.can_copy:
+            # flushing makes the size of everything added so far exact
+            self.flush()
+        if self.bound(len(data)) <= self.max_size:
+            self.write(data)
+            if self.pending >= SYNC_FLUSH_INTERVAL:
+                self.flush()
+            self.num_items += 1
+            return True
+        if not self.can_copy:
+            return False
+
+        state = (self.compressor.copy(), len(self.chunks), self.size, self.pending)
+        self.write(data)
+        self.flush()
+        if self.bound(0) <= self.max_size:
+            self.num_items += 1
+            return True
+
+        self.compressor, num_chunks, self.size, self.pending = state
+        del self.chunks[num_chunks:]
+        return False
+
+    def finish(self):
+        self.write(b"]")
+        self.chunks.append(self.compressor.finish())
+        return b"".join(self.chunks)
+
+# Splits a list into compressed JSON lists that each fit in a DynamoDB item
+# Each item is serialized and compressed once, and a partition is sealed as soon as the next
+# item doesn't fit in it, so partitions are filled close to max_partition_size and can't go over it
+def partition_and_compress_list(data_list, max_partition_size=MAX_PARTITION_SIZE, codec=None):
+    if codec is None:
+        codec = compression.get_codec()
     partitions = []
-    for i in range(num_partitions):
-        lower = i * tracks_per_partition
-        upper = (i + 1) * tracks_per_partition
-        partition = data_list[lower:upper]
-        partition_compressed = compress_data(partition)
+    partition = PartitionCompressor(max_partition_size, codec)
+    for item in data_list:
+        item = json.dumps(item).encode('utf-8')
+        if partition.add(item):
+            continue
+
+        if partition.num_items == 0:
+            raise ValueError(f"An item of {len(item)} bytes doesn't fit in a partition")
+        partitions.append(partition.finish())
+        partition = PartitionCompressor(max_partition_size, codec)
+        if not partition.add(item):
+            raise ValueError(f"An item of {len(item)} bytes doesn't fit in a partition")
+
+    partitions.append(partition.finish())
 
-        partitions.append(partition_compressed)
-    
     return partitions
 
 def get_current_time():
@@ -232,16 +309,12 @@ def scrape_library(token):
 
     profile = scrape_profile(token)
     user_id = profile['id']
-    logger.info(f"writing {user_id} --> 'profile' : {profile} ({profile.__sizeof__()/1024:.1f} KB) ")
-    db.update(user_id, "profile", profile)
-
     scrape_time = get_current_time()
-    logger.info(f"writing {user_id} --> 'scrape_time' : {scrape_time} ({scrape_time.__sizeof__()/1024:.1f} KB) ")
-    db.update(user_id, "scrape_time", scrape_time)
-
     message = "Scraping library"
+    logger.info(f"writing {user_id} --> 'profile' : {profile} ({profile.__sizeof__()/1024:.1f} KB) ")
+    logger.info(f"writing {user_id} --> 'scrape_time' : {scrape_time} ({scrape_time.__sizeof__()/1024:.1f} KB) ")
     logger.info(f"writing {user_id} --> 'message' : {message} ({message.__sizeof__()/1024:.1f} KB) ")
-    db.update(user_id, "message", message)
+    db.update_many(user_id, { "profile" : profile, "scrape_time" : scrape_time, "message" : message })
     
     tracks = scrape_user_tracks(token)
     track_ids = [track["id"] for track in tracks]
@@ -268,19 +341,65 @@ def scrape_library(token):
     logger.info(f"writing {user_id} --> 'message' : {message} ({message.__sizeof__()/1024:.1f} KB) ")
     db.update(user_id, "message", message)
 
+    # every partition is written before the keys that point to them
     partition_keys = []
+    partition_items = []
     for i, partition in enumerate(tracks_partitioned):
         partition_key = f"{user_id}_tracks_{i}"
         partition_keys.append(partition_key)
+        partition_items.append({ db.primary_key : partition_key, "tracks" : partition })
         logger.info(f"writing {partition_key} --> 'tracks' : Bytes(partition) ({partition.__sizeof__()/1024:.1f} KB) ")
-        db.update(partition_key, "tracks", partition)
-
-    logger.info(f"writing {user_id} --> 'partition_keys' : {partition_keys} ({partition_keys.__sizeof__()/1024:.1f} KB) ")
-    db.update(user_id, "partition_keys", partition_keys)
+    db.batch_write(partition_items)
 
     message = "Done"
+    logger.info(f"writing {user_id} --> 'partition_keys' : {partition_keys} ({partition_keys.__sizeof__()/1024:.1f} KB) ")
     logger.info(f"writing {user_id} --> 'message' : {message} ({message.__sizeof__()/1024:.1f} KB) ")
-    db.update(user_id, "message", message)
+    db.update_many(user_id, { "partition_keys" : partition_keys, "message" : message })
+
+# Yields the tracks of a library written by scrape_library, in order
+# The partitions are fetched batch_size at a time with BatchGetItem, with up to max_workers
+# requests in flight at once, and each is decompressed on the thread that fetched it (zlib
+# and zstd don't hold the GIL), so tracks are yielded as soon as the first partitions arrive while
+# the rest are still being fetched
+def iter_library(user_id, db=None, batch_size=4, max_workers=8):
+    if db is None:
+        db = DataBase("Wayfinder")
+
+    user = db.get(user_id)
+    if user is None:
+        raise KeyError(f"No library found for {user_id}")
+    partition_keys = user.get("partition_keys", [])
+    batches = [partition_keys[i:i + batch_size] for i in range(0, len(partition_keys), batch_size)]
+
+    def fetch_partitions(keys):
+        items = db.batch_get(keys)
+        missing = [key for key in keys if key not in items]
+        if missing:
+            raise KeyError(f"Missing library partitions {missing}")
+        return [compression.decompress(items[key]["tracks"].value) for key in keys]
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches))))
+    futures = [executor.submit(fetch_partitions, keys) for keys in batches]
+    try:
+        # waiting on the futures in order keeps the tracks in order, while later batches keep downloading
+        for future in futures:
+            for partition in future.result():
+                yield from json.loads(partition.decode('utf-8'))
+    finally:
+        # if the caller stops early (the generator is closed) or a batch fails, don't wait for the
+        # batches that are still downloading, and don't start the ones that haven't yet
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+# Reads a library written by scrape_library, as a list of tracks or, with stream, an
+# iterator over them (see iter_library)
+def load_library(user_id, db=None, stream=False, batch_size=4, max_workers=8):
+    tracks = iter_library(user_id, db=db, batch_size=batch_size, max_workers=max_workers)
+    if stream:
+        return tracks
+
+    return list(tracks)
 
 def lambda_handler(event, context):
     assert("token" in event.keys())
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# Builds the binary genre table that genre_table.py loads from the genre table JSON
+# Run this whenever data/data_genres_average_features.json changes, and commit the output
+#
+# usage: python scripts/build_genre_table.py [--json data/data_genres_average_features.json]
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import genre_table
+
+def build(json_file, features_file, names_file):
+    with open(json_file, "r") as f:
+        genres = json.loads(f.read())
+
+    # every key except the name and uri is a feature, in the order of the JSON
+    feature_names = [key for key in genres[0] if key not in ["name", "uri"]]
+    features = np.array([[genre[feature_name] for feature_name in feature_names] for genre in genres],
+                        dtype=np.float32)
+    table = {
+        "names" : [genre["name"] for genre in genres],
+        "uris" : [genre["uri"] for genre in genres],
+        "feature_names" : feature_names,
+    }
+    # changes whenever the table does, e.g. to version the URL the front end fetches it from
+    content = json.dumps(table, sort_keys=True).encode("utf-8") + features.tobytes()
+    table["version"] = hashlib.sha256(content).hexdigest()[:16]
+
+    np.save(features_file, features)
+    with open(names_file, "w") as f:
+        f.write(json.dumps(table, separators=(",", ":")))
+
+    return table, features
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json", default=os.path.join(genre_table.DATA_DIR, "data_genres_average_features.json"))
+    parser.add_argument("--features", default=genre_table.FEATURES_FILE)
+    parser.add_argument("--names", default=genre_table.NAMES_FILE)
+    args = parser.parse_args()
+
+    table, features = build(args.json, args.features, args.names)
+    print(f"{len(table['names'])} genres x {len(table['feature_names'])} features, version {table['version']}")
+    print(f"{args.features}: {os.path.getsize(args.features)} bytes")
+    print(f"{args.names}: {os.path.getsize(args.names)} bytes")
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@ var genreCountsGlobal;
 var umbrellaCountsGlobal;
 var topUmbrellaCountsGlobal;
 var userProfileGlobal;
+var umbrellaDataGlobal;
 
 // The default time range for the jQuery slider
 var defaultTimeRange = [2010, 2019];
@@ -50,73 +51,8 @@ function rgb(r, g, b){
 var genre_colors = [rgb(221,158,213), rgb(233, 99, 99), rgb(67,148,179), 	rgb(130, 201, 166), rgb(252,189,116),     rgb(193, 152, 139), rgb(80,80,80),  'silver']
 var attributeDescriptors = {'energy': ['dense & atmospheric','spiky & bouncy'], 'liveness': ['XXX','XXX'], 'speechiness': ['no speech','spoken words'], 'acousticness': ['mechanical','organic'], 'instrumentalness': ['more vocals','only instruments'], 'danceability': ['less danceable','more danceable'], 'loudness': ['quiet','loud'], 'valence': ['less happy','more happy'], 'popularity': ['less popular','more popular']};
 
-// Takes in a genre name string and returns a dictionary indicating which umbrella genres it belongs to
-var genre_classifiers = {
-    "Rock" : function(genre) { 
-        return genre.toLowerCase().includes('rock') || 
-                genre.toLowerCase().includes('punk') || 
-                genre.toLowerCase().includes('grunge') || 
-                genre.toLowerCase().includes('indie') || 
-                genre.toLowerCase().includes('garage');
-    },
-    "Pop" : function(genre) {
-        return genre.toLowerCase().includes('pop')
-    },
-    "Rap" : function(genre) {
-        return ((genre.toLowerCase().includes('rap'))
-         || (genre.toLowerCase().includes('hip hop')) 
-         || (genre.toLowerCase().includes('hiphop')))
-         && (!genre.toLowerCase().includes('traprun'))
-         && (!genre.toLowerCase().includes('electronic trap'))
-         && (!genre.toLowerCase().includes('bass trap'));
-    },
-    "Electronic" : function(genre) {
-        return ((genre.toLowerCase().includes('electro')) || 
-                (genre.toLowerCase().includes('tronica')) || 
-                (genre.toLowerCase().includes('house')) || 
-                (genre.toLowerCase().includes('techno')) || 
-                (genre.toLowerCase().includes('edm')) || 
-                (genre.toLowerCase().includes('trance')) || 
-                (genre.toLowerCase().includes('dub')) || 
-                (genre.toLowerCase().includes('chip')) || 
-                (genre.toLowerCase().includes('glitch')) || 
-                (genre.toLowerCase().includes('jungle')) ||
-                (genre.toLowerCase().includes('idm')) ||
-                (genre.toLowerCase().includes('traprun')) ||
-                (genre.toLowerCase().includes('chillstep')) ||
-                (genre.toLowerCase().includes('chillwave')) ||
-                (genre.toLowerCase().includes('bass trap'))) && 
-                (!genre.toLowerCase().includes('edmunds')) && 
-                (!genre.toLowerCase().includes('edmonton')) && 
-                (!genre.toLowerCase().includes('dublin'));
-    },
-    "Classical" : function(genre) {
-        return (genre.toLowerCase().includes('classical')) ||
-                (genre.toLowerCase().includes('baroque')) ||
-                (genre.toLowerCase().includes('choir')) ||
-                ((genre.toLowerCase().includes('orchestra')) &&
-                (!genre.toLowerCase().includes('jazz')) );
-    },
-    "Metal" : function(genre) {
-        return (genre.toLowerCase().includes('metal')) || 
-                (genre.toLowerCase().includes('death')) || 
-                (genre.toLowerCase().includes('hardcore')) || 
-                (genre.toLowerCase().includes('thrash'));
-    },
-    "Jazz" : function(genre) {
-        return (genre.toLowerCase().includes('jazz')) || 
-                (genre.toLowerCase().includes('ragtime'));
-    },
-    "Other" : function(genre) {
-        return !(genre_classifiers["Rock"](genre) || 
-                 genre_classifiers["Pop"](genre) || 
-                 genre_classifiers["Rap"](genre) || 
-                 genre_classifiers["Electronic"](genre) || 
-                 genre_classifiers["Classical"](genre) || 
-                 genre_classifiers["Metal"](genre)|| 
-                 genre_classifiers["Jazz"](genre));
-    }
-}
+// Songs and genres are classified into the umbrella genres on the server when the library is
+// scraped (see umbrella.py), and loaded with loadUmbrellaData()
 
 // Map all of the umbrella genres to a unique color
 var umbrellaGenreToColor = d3.scaleOrdinal()
@@ -140,17 +76,6 @@ var nbsp = " &nbsp;" // Define a string containing the HTML non-breaking space s
 // UTILITY FUNCTIONS //
 ///////////////////////
 
-function classifyUmbrellaGenre(genre) {
-    // genre
-    var umbrellas = [];
-    genre_labels.forEach(function(umbrella) {
-        if (genre_classifiers[umbrella](genre)) {
-            umbrellas.push(umbrella);
-        }
-    });
-    return umbrellas;
-}
-
 // Create a plot to draw things
 // selector should be e.g. "#line-chart" to select a div on the page with id line-chart
 // this returns the selected svg and creates a dictionary representing each axis
@@ -905,40 +830,29 @@ function updateLinePlot(songData, genreData, plot) {
                     .domain(defaultTimeRange)
                     .range([0., xAxis["length"]]);
                 
-    // Create a function that will bin data in a consistent way on the date added
-    // attribute of any data passed
-    var num_bins = 50;
-    var bin_edges = xScale.ticks(num_bins);
-
-    var bin_data = d3.histogram()
-                     .value(function(d) {
-                         return Date.parse(d['dateAdded']);
-                     })
-                     .domain(xScale.domain())
-                     .thresholds(bin_edges);
-
-    var binned_data = bin_data(filtered_data);
-    binned_data.forEach(function(bin) {
-        bin['xMid'] = new Date((Date.parse(bin['x0']) + Date.parse(bin['x1'])) / 2);
-        bin['x0'] = new Date(bin['x0']);
-        bin['x1'] = new Date(bin['x1']);
-    });
-
+    // Songs were binned on the date they were added by the server (see umbrella.py), which also
+    // counted the songs in each bin for the whole library, so only filtered data is counted here
+    var timeBins = umbrellaDataGlobal["timeBins"];
+    var unfiltered = (songData === songDataGlobal);
     var genre_bin_data = [];
-    binned_data.forEach(function(bin) {
-        genre_bin_data.push({"date" : bin['x1']});
-
-        counts = countGenres(bin, genreData);
-        genre_counts = counts[0];
-        umbrella_genre_counts = counts[1];
-        top_umbrella_genre_counts = counts[2];
-
-        genre_labels.forEach(function(umbrella_genre) {
-            var last_index = genre_bin_data.length - 1;
-            // genre_bin_data[last_index][umbrella_genre] = umbrella_genre_counts[umbrella_genre]["userCount"]; Steven, for now I've replaced the weighted umbrella counts with a count of songs in each top umbrella, those numbers are looking less wonky
-            genre_bin_data[last_index][umbrella_genre] = top_umbrella_genre_counts[umbrella_genre]["userCount"];
+    if (timeBins) {
+        timeBins["edges"].slice(1).forEach(function(edge, i) {
+            var bin = {"date" : new Date(edge)};
+            genre_labels.forEach(function(umbrella_genre) {
+                // a count of songs in each top umbrella, rather than the weighted umbrella counts
+                bin[umbrella_genre] = unfiltered ? timeBins["topUmbrellaCounts"][umbrella_genre][i] : 0;
+            });
+            genre_bin_data.push(bin);
         });
-    });
+
+        if (!unfiltered) {
+            filtered_data.forEach(function(song) {
+                if (song["timeBin"] !== null) {
+                    genre_bin_data[song["timeBin"]][song["topUmbrellaMatches"][0]] += 1;
+                }
+            });
+        }
+    }
 
     // Make a stack that will convert the above data into an array of series
     // where there will be a series for each key given
@@ -1741,119 +1655,50 @@ function loadPage() {
 ///////////////////////////////////////////////
 
 // A function to process the user library data
-function songDataProcess(songData, genreData) {
-    songData.forEach(function(s) {
-        s.counts = [];
-        // Classify each song into umbrella genres
-        // As you classify each genre associated with this song, keep a tally of how many times each umbrella genre is assigned
-        tallySongUmbrellas = [];
-        // Initialize all isX keys to false and set tallies to 0
-        genre_labels.forEach(function(umbrella) {
-            s["is" + umbrella] = false;
-            s["count" + umbrella] = 0;
-            //tallySongUmbrellas[umbrella] = 0;
-            //tallySongUmbrellas[umbrella] = [];
-            //tallySongUmbrellas[umbrella]["tally"] = 0;
-            tallySongUmbrellas[umbrella] = 0;
-        });
-
-        s.genres.forEach(function(genre) { // Loop through all genres associated with this song and assign umbrella genres to the song
-            // for example this returns ["isRock", "isPop", "isMetal"]
-            var songUmbrellas = classifyUmbrellaGenre(genre);
-            songUmbrellas.forEach(function(umbrella) {
-                s["is" + umbrella] = true;
-                s["count" + umbrella] += 1; // This will keep a tally of how many times each umbrella genre is assigned to the song
-            });
-            // this will evaluate to:
-            // s.isRock --> true
-            // s.isPop --> true
-            // s.isMetal --> true
+// umbrellaData holds each song's umbrella genres, in the same order as the library
+function songDataProcess(songData, umbrellaData) {
+    var songUmbrellas = umbrellaData["songs"];
+    songData.forEach(function(s, i) {
+        // How many of the song's genres belong to each umbrella genre, e.g.
+        // s.countRock --> 2, s.isRock --> true
+        var counts = songUmbrellas["counts"][i];
+        umbrellaData["genreLabels"].forEach(function(umbrella, j) {
+            s["count" + umbrella] = counts[j];
+            s["is" + umbrella] = counts[j] > 0;
         });
+        // The umbrella genre(s) with the highest count, ties with "Other" going to the others
+        s["topUmbrellaMatches"] = songUmbrellas["topUmbrellaMatches"][i];
+        // The bin of the line plot the song falls in, null without a date
+        s["timeBin"] = songUmbrellas["timeBin"][i];
 
         // Take the date string and create a JS Date Object (date string format is "2019-05-27T04:34:26Z")
         s.dateAdded = parseUTCTime(s.date);
-
-        var maxCount = 0;  // temporary counter
-        s["topUmbrellaMatches"] = []; // This will be an array of the genre(s) that have the highest count
-        genre_labels.forEach(function(umbrella) {
-            if (s["count" + umbrella] > maxCount) { // if the count for this umbrella is the highest so far, set that as the top umbrella
-                maxCount = s["count" + umbrella];
-                s["topUmbrellaMatches"] = [umbrella]
-            } else if (s["count" + umbrella] == maxCount) { // if the count for this umbrella ties with another umbrella, add it to the list of top umbrellas
-                s["topUmbrellaMatches"].push(umbrella);
-            }
-        });
-        // Finally, if there is more than one topUmbrellaMatch, don't classify it as "Other"
-        if (s["topUmbrellaMatches"].length > 1) {
-            s["topUmbrellaMatches"] = s["topUmbrellaMatches"].filter(genre => genre != "Other")
-        }
-
-
-        // This is where we would calculate closest genre for top umbrellas that are tied
-
     })
-    // Add "closestGenre" key
-    // This is where the distance stuff would go
 
     return songData;
 }
 
-// A function to process the user library data
-function genreDataProcess(songData, genreData) {
-    var genre_dates = {}        // Date the genre is first/last added to user's library
-
-    // Check each song to get first & last add dates for each genre
-    songData.forEach(function(s){
-        s.genres.forEach(function(g) { 
-            // Take the date string and create a JS Date Object (date string format is "2019-05-27T04:34:26Z")
-            s.dateAdded = parseUTCTime(s.date);
-            // Check the first/last add date for each of the song's genres, and update it if this song was added before that date
-            if (genre_dates[g]) {
-                if (s.dateAdded < genre_dates[g]["userFirstAddDate"]) {
-                    genre_dates[g]["userFirstAddDate"] = s.dateAdded
-                }
-                if (s.dateAdded > genre_dates[g]["userLastAddDate"]) {
-                    genre_dates[g]["userLastAddDate"] = s.dateAdded
-                }
-            } else {
-                genre_dates[g] = {};
-                genre_dates[g]["userFirstAddDate"] = s.dateAdded
-                genre_dates[g]["userLastAddDate"] = s.dateAdded
-            }
-
-        })
-    })
-
+// A function to process the genre data
+function genreDataProcess(genreData, umbrellaData) {
+    // Dates each genre was first/last added to the user's library
+    var genre_dates = umbrellaData["genreDates"];
 
     // Do the following for every element in the json file
     genreData.forEach(function(g) {
-        
         key = g['name'].toLowerCase()
         genre_in_library = genre_dates[key];
         if (genre_in_library) {
-            g.userFirstAddDate = genre_dates[key]["userFirstAddDate"];
-            g.userLastAddDate = genre_dates[key]["userLastAddDate"];
+            g.userFirstAddDate = parseUTCTime(genre_in_library[0]);
+            g.userLastAddDate = parseUTCTime(genre_in_library[1]);
         }
 
-
-        // Identify umbrella genres and top umbrella matches
+        // Umbrella genres and top umbrella matches
+        g["topUmbrellaMatches"] = umbrellaData["genres"][g.name] || ["Other"];
         genre_labels.forEach(function(umbrella) {
-            g["is" + umbrella] = false;
-        });
-        var songUmbrellas = classifyUmbrellaGenre(g.name);
-        g["topUmbrellaMatches"] = songUmbrellas;
-        songUmbrellas.forEach(function(umbrella) {
-            g["is" + umbrella] = true;
+            g["is" + umbrella] = g["topUmbrellaMatches"].includes(umbrella);
         });
-        // If there is more than one topUmbrellaMatch, don't classify it as "Other"
-        if (g["topUmbrellaMatches"].length > 1) {
-            g["topUmbrellaMatches"] = g["topUmbrellaMatches"].filter(genre => genre != "Other")
-        };            
     });
 
-
-
-
     return genreData;
 }
 
@@ -1865,7 +1710,8 @@ Promise.all([loadSongData(),
              loadTopArtistsData(), 
              loadTopTracksData(), 
              loadRecentlyPlayedData(),
-             loadUserProfile()
+             loadUserProfile(),
+             loadUmbrellaData()
             ]).then(function(results) {
                  
     console.log("Finished loading Song and Genre Data!");
@@ -1876,12 +1722,13 @@ Promise.all([loadSongData(),
     topTracksGlobal = results[3];
     recentlyPlayedGlobal = results[4];
     userProfileGlobal = results[5];
+    umbrellaDataGlobal = results[6];
 
     // Apply pre-processing of the data before we plot
     // This will liike like adding keys like "isRock" to the song and genre objects
     // that we expect to be there when plotting
-    songDataGlobal = songDataProcess(songDataGlobal, genreDataGlobal);
-    genreDataGlobal = genreDataProcess(songDataGlobal, genreDataGlobal);
+    songDataGlobal = songDataProcess(songDataGlobal, umbrellaDataGlobal);
+    genreDataGlobal = genreDataProcess(genreDataGlobal, umbrellaDataGlobal);
 
     // Add a new key to each song in songDataGlobal that corresponds to the *one* genre
     // that the song should belong to 
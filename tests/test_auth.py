@@ -0,0 +1,78 @@
+import time
+import threading
+
+import auth
+
+# Credentials whose token requests block until release is set
+class SlowCredentials(auth.CachedClientCredentials):
+    def __init__(self, error=None):
+        super().__init__("id", "secret")
+        self.release = threading.Event()
+        self.num_requests = 0
+        self.error = error
+
+    def request_token(self):
+        self.num_requests += 1
+        self.release.wait(10)
+        if self.error is not None:
+            raise self.error
+        return { "access_token" : "token{}".format(self.num_requests), "expires_in" : 3600,
+                 "expires_at" : time.time() + 3600 }
+
+def get_tokens(credentials, num_threads):
+    results = [None] * num_threads
+    def get_token(i):
+        try:
+            results[i] = credentials.get_access_token()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=get_token, args=(i,)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+def test_single_fetch_outside_the_lock():
+    credentials = SlowCredentials()
+    threads, results = get_tokens(credentials, 8)
+
+    time.sleep(0.2)
+    # the request in flight doesn't hold the lock
+    assert credentials.lock.acquire(timeout=1)
+    credentials.lock.release()
+
+    credentials.release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert credentials.num_requests == 1
+    assert results == ["token1"] * 8
+
+def test_error_reaches_every_waiter():
+    credentials = SlowCredentials(error=RuntimeError("no token"))
+    threads, results = get_tokens(credentials, 4)
+
+    time.sleep(0.2)
+    credentials.release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert credentials.num_requests == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    # and the next request tries again
+    credentials.error = None
+    assert credentials.get_access_token() == "token2"
+
+def test_refresh_ahead_keeps_current_token():
+    credentials = SlowCredentials()
+    credentials.token_info = { "access_token" : "old", "expires_at" : time.time() + 10 }
+
+    assert credentials.get_access_token() == "old"
+    assert credentials.get_access_token() == "old"
+    credentials.release.set()
+
+    deadline = time.monotonic() + 5
+    while credentials.get_access_token() == "old" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert credentials.get_access_token() == "token1"
+    assert credentials.num_requests == 1
@@ -0,0 +1,54 @@
+import os
+
+import cache
+
+def make_cache(tmp_path, max_bytes=1024 ** 2):
+    root = tmp_path / "data"
+    root.mkdir()
+    return cache.FolderCache(str(root), max_bytes, path=str(tmp_path / "cache.sqlite"))
+
+def write_folder(folder_cache, name, size):
+    folder = folder_cache.get_folder(name)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "data.json"), "wb") as f:
+        f.write(b"x" * size)
+
+def test_lookup_only_writes_stale_access_times(tmp_path, monkeypatch):
+    folder_cache = make_cache(tmp_path)
+    write_folder(folder_cache, "user", 100)
+    folder_cache.record_write("user")
+
+    writes = []
+    monkeypatch.setattr(folder_cache, "put_entry", lambda *args: writes.append(args))
+    accessed = folder_cache.get_entry("user")["accessed"]
+    for _ in range(5):
+        assert folder_cache.lookup("user")
+    assert writes == []
+    assert folder_cache.get_entry("user")["accessed"] == accessed
+
+    # an access time older than access_resolution is brought up to date
+    folder_cache.access_resolution = 0
+    assert folder_cache.lookup("user")
+    assert folder_cache.get_entry("user")["accessed"] > accessed
+
+def test_record_write_only_scans_when_over_budget(tmp_path, monkeypatch):
+    folder_cache = make_cache(tmp_path, max_bytes=1000)
+    write_folder(folder_cache, "old", 400)
+    write_folder(folder_cache, "user", 100)
+    # the first write of a process scans root
+    folder_cache.record_write("user")
+
+    syncs = []
+    sync = folder_cache.sync
+    monkeypatch.setattr(folder_cache, "sync", lambda: syncs.append(1) or sync())
+    for size in [200, 300, 400]:
+        write_folder(folder_cache, "user", size)
+        folder_cache.record_write("user")
+    assert syncs == []
+    assert folder_cache.get_entry("user")["size"] == 400
+
+    write_folder(folder_cache, "user", 700)
+    folder_cache.record_write("user")
+    assert syncs == [1]
+    assert not os.path.exists(folder_cache.get_folder("old"))
+    assert folder_cache.get_total_size() == 700
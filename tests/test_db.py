@@ -0,0 +1,176 @@
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("boto3")
+
+import db
+
+TABLE = "Wayfinder"
+
+# Stands in for the DynamoDB client: records every request, and leaves the first
+# `unprocessed` items / keys of each of the first `throttled` requests unprocessed
+class StubClient():
+    def __init__(self, unprocessed=0, throttled=0):
+        self.unprocessed = unprocessed
+        self.throttled = throttled
+        self.write_requests = []
+        self.get_requests = []
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def batch_write_item(self, RequestItems):
+        requests = RequestItems[TABLE]
+        assert len(requests) <= db.BATCH_WRITE_SIZE
+        with self.lock:
+            self.write_requests.append(requests)
+            throttle = len(self.write_requests) <= self.throttled
+        unprocessed = requests[:self.unprocessed] if throttle else []
+        for request in requests[len(unprocessed):]:
+            item = request["PutRequest"]["Item"]
+            with self.lock:
+                self.items[item["user_id"]["S"]] = item
+
+        return { "UnprocessedItems" : { TABLE : unprocessed } if unprocessed else {} }
+
+    def batch_get_item(self, RequestItems):
+        keys = RequestItems[TABLE]["Keys"]
+        assert len(keys) <= db.BATCH_GET_SIZE
+        self.get_requests.append(keys)
+        throttle = len(self.get_requests) <= self.throttled
+        unprocessed = keys[:self.unprocessed] if throttle else []
+        responses = [self.items[key["user_id"]["S"]] for key in keys[len(unprocessed):] if key["user_id"]["S"] in self.items]
+
+        response = { "Responses" : { TABLE : responses } }
+        if unprocessed:
+            response["UnprocessedKeys"] = { TABLE : { "Keys" : unprocessed } }
+        return response
+
+class StubTable():
+    def __init__(self):
+        self.updates = []
+
+    def update_item(self, **kwargs):
+        self.updates.append(kwargs)
+
+def make_database(client):
+    database = db.DataBase.__new__(db.DataBase)
+    database.dynamodb_client = client
+    database.table = StubTable()
+    database.table_name = TABLE
+    database.primary_key = "user_id"
+    return database
+
+def make_items(n):
+    return [{ "user_id" : f"user-{i}", "value" : i } for i in range(n)]
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_batch_write_splits_into_batches_of_25(max_workers):
+    client = StubClient()
+    make_database(client).batch_write(make_items(60), max_workers=max_workers)
+
+    assert sorted(len(requests) for requests in client.write_requests) == [10, 25, 25]
+    assert len(client.items) == 60
+
+def test_batch_write_retries_unprocessed_items():
+    client = StubClient(unprocessed=5, throttled=2)
+    make_database(client).batch_write(make_items(25), max_workers=1, delay=0)
+
+    # the first request leaves 5 items, the retry of those 5 leaves all 5 again, the third gets them
+    assert [len(requests) for requests in client.write_requests] == [25, 5, 5]
+    assert len(client.items) == 25
+    assert client.items["user-0"]["value"] == { "N" : "0" }
+
+def test_batch_write_gives_up_after_max_retries():
+    client = StubClient(unprocessed=3, throttled=100)
+    with pytest.raises(RuntimeError):
+        make_database(client).batch_write(make_items(10), max_workers=1, max_retries=2, delay=0)
+
+    assert len(client.write_requests) == 3
+
+def test_batch_get_retries_unprocessed_keys():
+    client = StubClient()
+    database = make_database(client)
+    database.batch_write(make_items(150), max_workers=1)
+
+    client.unprocessed, client.throttled = 10, 1
+    found = database.batch_get([f"user-{i}" for i in range(150)] + ["missing"], delay=0)
+
+    assert [len(keys) for keys in client.get_requests] == [100, 10, 51]
+    assert len(found) == 150
+    assert found["user-7"] == { "user_id" : "user-7", "value" : 7 }
+
+def test_update_many_sets_every_attribute_in_one_update():
+    database = make_database(StubClient())
+    database.update_many("user-1", { "status" : "Done", "num_tracks" : 3 })
+
+    (update,) = database.table.updates
+    assert update["Key"] == { "user_id" : "user-1" }
+    assert update["UpdateExpression"] == "SET #k0 = :v0, #k1 = :v1"
+    assert update["ExpressionAttributeNames"] == { "#k0" : "status", "#k1" : "num_tracks" }
+    assert update["ExpressionAttributeValues"] == { ":v0" : "Done", ":v1" : 3 }
+
+# The same requests against moto's in-memory DynamoDB
+@pytest.fixture
+def moto_table(monkeypatch):
+    moto = pytest.importorskip("moto")
+    for key, value in [("AWS_DEFAULT_REGION", "us-east-1"), ("AWS_ACCESS_KEY_ID", "test"), ("AWS_SECRET_ACCESS_KEY", "test")]:
+        monkeypatch.setenv(key, value)
+    monkeypatch.setattr(db, "ENDPOINT_URL", None)
+
+    with moto.mock_aws():
+        # clients created outside of the mock would talk to AWS
+        monkeypatch.setattr(db, "_dynamodb", None)
+        _, client = db.get_dynamodb()
+        client.create_table(
+            TableName="Wayfinder",
+            KeySchema=[{ "AttributeName" : "user_id", "KeyType" : "HASH" }],
+            AttributeDefinitions=[{ "AttributeName" : "user_id", "AttributeType" : "S" }],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield db.DataBase("Wayfinder")
+
+    db._dynamodb = None
+
+def make_tracks(n):
+    # random names, so the partitions don't compress below one item each
+    return [{ "id" : f"track-{i}", "name" : os.urandom(200).hex(), "artists" : [{ "id" : f"artist-{i % 7}" }] }
+            for i in range(n)]
+
+def test_scrape_and_load_library_with_moto(moto_table, monkeypatch):
+    import scrape_db
+
+    tracks = make_tracks(6000)
+    monkeypatch.setattr(scrape_db, "DataBase", lambda table_name: moto_table)
+    monkeypatch.setattr(scrape_db, "scrape_profile", lambda token: { "id" : "user-1" })
+    monkeypatch.setattr(scrape_db, "scrape_user_tracks", lambda token: [dict(track) for track in tracks])
+    monkeypatch.setattr(scrape_db, "scrape_audio_features", lambda track_ids, token: {})
+    monkeypatch.setattr(scrape_db, "scrape_genres", lambda artist_ids, token: {})
+    monkeypatch.setattr(scrape_db, "compile_library", lambda tracks, audio_features, genres: None)
+    # moto measures binary attributes by the length of their base64 encoding, a third more than
+    # DynamoDB does, so full size partitions would be rejected
+    partition = scrape_db.partition_and_compress_list
+    monkeypatch.setattr(scrape_db, "partition_and_compress_list",
+                        lambda data_list: partition(data_list, max_partition_size=32 * 1024))
+
+    scrape_db.scrape_library("token")
+
+    user = moto_table.get("user-1")
+    assert user["message"] == "Done"
+    # more partitions than fit in one BatchWriteItem request
+    assert len(user["partition_keys"]) > db.BATCH_WRITE_SIZE
+
+    assert scrape_db.load_library("user-1", db=moto_table, batch_size=2, max_workers=4) == tracks
+
+    # a stream closed early stops without reading the rest
+    stream = scrape_db.load_library("user-1", db=moto_table, stream=True, batch_size=1)
+    assert [next(stream) for _ in range(3)] == tracks[:3]
+    stream.close()
+
+def test_batch_get_with_moto(moto_table):
+    moto_table.batch_write(make_items(130))
+
+    found = moto_table.batch_get([f"user-{i}" for i in range(130)] + ["missing"])
+    assert len(found) == 130
+    assert found["user-42"] == { "user_id" : "user-42", "value" : 42 }
@@ -0,0 +1,71 @@
+import time
+
+import pytest
+import requests
+
+import http_client
+import rate_limit
+
+# Answers every request with the next of the given responses: a status code, a (status code,
+# headers) pair or an exception to raise
+class StubAdapter(requests.adapters.BaseAdapter):
+    def __init__(self, responses):
+        super().__init__()
+        self.responses = list(responses)
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        answer = self.responses.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        status, headers = answer if isinstance(answer, tuple) else (answer, {})
+
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def session(monkeypatch):
+    # no real waiting between retries
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+
+    def make_session(responses):
+        session = http_client.RateLimitedSession(rate_limit.RateLimiter(rate=1000, burst=1000))
+        adapter = StubAdapter(responses)
+        session.mount("https://", adapter)
+        return session, adapter
+
+    return make_session
+
+def test_get_is_retried(session):
+    session, adapter = session([503, requests.exceptions.ConnectionError(), (429, { "Retry-After" : "1" }), 200])
+
+    assert session.get("https://api.spotify.com/v1/me").status_code == 200
+    assert len(adapter.requests) == 4
+
+def test_post_is_not_retried(session):
+    session, adapter = session([requests.exceptions.ReadTimeout(), 200])
+
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        session.post("https://accounts.spotify.com/api/token", data={ "grant_type" : "authorization_code" })
+    assert len(adapter.requests) == 1
+
+def test_long_retry_after_fails_fast(session):
+    session, adapter = session([(429, { "Retry-After" : "600" }), 200])
+
+    start = time.monotonic()
+    assert session.get("https://api.spotify.com/v1/me").status_code == 429
+    assert len(adapter.requests) == 1
+    # the process wide pause is capped too
+    assert session.limiter.paused_until - start <= rate_limit.MAX_DELAY + 1
+
+def test_backoff_is_capped():
+    assert rate_limit.get_backoff(0, retry_after=600) <= rate_limit.MAX_DELAY
+    assert rate_limit.get_backoff(20) <= rate_limit.MAX_DELAY
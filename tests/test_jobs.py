@@ -0,0 +1,134 @@
+import os
+import time
+import multiprocessing
+
+import pytest
+
+import api_call
+import cache
+import jobs
+
+USER_ID = "test_user"
+
+# fork, so that the child processes see DATA_FOLDER as patched by the test
+context = multiprocessing.get_context("fork")
+
+@pytest.fixture(autouse=True)
+def data_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_call, "DATA_FOLDER", str(tmp_path))
+    # the user data cache is created again, with its index in tmp_path rather than the real
+    # cache.CACHE_DB
+    monkeypatch.setattr(cache, "CACHE_DB", str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(jobs, "_user_data_cache", None)
+
+def hold_scrape_lock(held, done):
+    lock = jobs.ScrapeLock(USER_ID)
+    lock.acquire()
+    held.set()
+    done.wait(10)
+    lock.release()
+
+def poll_is_scraping(stop):
+    while not stop.is_set():
+        jobs.is_scraping(USER_ID)
+
+def test_is_scraping_sees_other_process():
+    held, done = context.Event(), context.Event()
+    process = context.Process(target=hold_scrape_lock, args=(held, done))
+    process.start()
+    try:
+        assert held.wait(10)
+        assert jobs.is_scraping(USER_ID)
+        # and a job in this process leaves the scrape to it
+        assert not jobs.ScrapeLock(USER_ID).acquire(blocking=False)
+    finally:
+        done.set()
+        process.join(10)
+
+    assert not jobs.is_scraping(USER_ID)
+
+def test_is_scraping_does_not_take_the_lock():
+    os.makedirs(api_call.get_user_folder(USER_ID))
+    open(jobs.get_scrape_lock_file(USER_ID), "w").close()
+
+    stop = context.Event()
+    processes = [context.Process(target=poll_is_scraping, args=(stop,)) for _ in range(2)]
+    for process in processes:
+        process.start()
+    try:
+        # a job starting while other workers check on the user always gets the lock
+        deadline = time.monotonic() + 1
+        while time.monotonic() < deadline:
+            lock = jobs.ScrapeLock(USER_ID)
+            assert lock.acquire(blocking=False)
+            lock.release()
+    finally:
+        stop.set()
+        for process in processes:
+            process.join(10)
+
+def test_is_scraping_ignores_dead_process():
+    process = context.Process(target=lambda: None)
+    process.start()
+    process.join(10)
+
+    os.makedirs(api_call.get_user_folder(USER_ID))
+    with open(jobs.get_scrape_lock_file(USER_ID), "w") as f:
+        f.write(str(process.pid))
+
+    assert not jobs.is_scraping(USER_ID)
+
+def test_acquire_waits_for_other_process():
+    held, done = context.Event(), context.Event()
+    process = context.Process(target=hold_scrape_lock, args=(held, done))
+    process.start()
+    try:
+        assert held.wait(10)
+        assert not jobs.ScrapeLock(USER_ID).acquire(timeout=0.3)
+
+        done.set()
+        lock = jobs.ScrapeLock(USER_ID)
+        assert lock.acquire(timeout=5)
+        assert jobs.is_scraping(USER_ID)
+        lock.release()
+    finally:
+        done.set()
+        process.join(10)
+
+def test_scrape_job_writes_library_umbrellas(monkeypatch):
+    import library
+
+    records = [{ "genres" : ["indie rock", "dance pop"], "date" : "2020-01-01T00:00:00Z" },
+               { "genres" : ["jazz"], "date" : "2020-02-01T00:00:00Z" }]
+    os.makedirs(api_call.get_user_folder(USER_ID))
+    api_call.write_json(os.path.join(api_call.get_user_folder(USER_ID), "library.json"), records)
+    jobs.write_status(USER_ID, jobs.DONE, "Done")
+    monkeypatch.setattr(api_call, "scrape_data", lambda token, spotipy_session, user_id, **kwargs:
+                        { "library" : library.Library.from_records(records) })
+
+    # a library scraped before the umbrella genres were written goes through a job for them
+    assert api_call.needs_library_umbrellas(USER_ID)
+    status = jobs.ensure_scraped(USER_ID, "token", None)
+    assert status["state"] == jobs.QUEUED
+
+    future = jobs.get_runner().jobs.get(USER_ID)
+    if future is not None:
+        future.result(30)
+    assert jobs.read_status(USER_ID)["state"] == jobs.DONE
+    assert not api_call.needs_library_umbrellas(USER_ID)
+    assert jobs.ensure_scraped(USER_ID, "token", None)["state"] == jobs.DONE
+
+def test_scrape_job_with_empty_library(monkeypatch):
+    import library
+
+    os.makedirs(api_call.get_user_folder(USER_ID))
+    api_call.write_json(os.path.join(api_call.get_user_folder(USER_ID), "library.json"), [])
+    monkeypatch.setattr(api_call, "scrape_data", lambda token, spotipy_session, user_id, **kwargs:
+                        { "library" : library.Library.from_records([]) })
+
+    jobs.LocalJobRunner(max_workers=1).scrape(USER_ID, "token", None)
+
+    assert jobs.read_status(USER_ID)["state"] == jobs.DONE
+    assert not api_call.needs_library_umbrellas(USER_ID)
+    # so the next visit doesn't start another job
+    assert jobs.ensure_scraped(USER_ID, "token", None)["state"] == jobs.DONE
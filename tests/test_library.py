@@ -0,0 +1,50 @@
+import json
+
+import numpy as np
+import pytest
+
+from library import Library, OBJECT
+
+def make_records():
+    return [
+        { "name" : "a", "genres" : ["pop", "rock"], "energy" : 0.5, "mode" : 1, "popularity" : 10 },
+        { "name" : "b", "genres" : [], "energy" : 0.25, "mode" : 0.5, "popularity" : 20 },
+        { "name" : "c", "genres" : ["pop"], "energy" : 1.0, "mode" : 0, "popularity" : 30 },
+    ]
+
+def test_round_trip():
+    records = make_records()
+    library = Library.from_records(records)
+
+    assert library.to_records() == records
+    assert json.dumps(library.to_records()) == json.dumps(records)
+
+def test_mixed_int_and_float_column_round_trips():
+    records = make_records()
+    library = Library.from_records(json.loads(json.dumps(records)))
+
+    assert library.columns["mode"][0] == OBJECT
+    converted = library.to_records()
+    assert [record["mode"] for record in converted] == [1, 0.5, 0]
+    assert isinstance(converted[0]["mode"], int)
+
+def test_features_of_mixed_int_and_float_column():
+    library = Library.from_records(make_records())
+
+    features = library.features(["energy", "mode", "popularity"])
+    assert features.dtype == np.float32
+    np.testing.assert_allclose(features, [[0.5, 1, 10], [0.25, 0.5, 20], [1.0, 0, 30]])
+    np.testing.assert_allclose(library.mean_features(["mode"]), [0.5])
+
+def test_features_of_non_numeric_column():
+    library = Library.from_records(make_records())
+
+    with pytest.raises(ValueError):
+        library.features(["name"])
+
+def test_list_counts():
+    library = Library.from_records(make_records())
+
+    assert library.list_counts("genres") == { "pop" : 2, "rock" : 1 }
+    with pytest.raises(ValueError):
+        library.list_counts("name")
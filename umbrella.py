@@ -0,0 +1,148 @@
+import datetime
+
+# Umbrella genres (Pop, Rock, Rap, ...) of a user's songs and of every genre, and how many of
+# the user's songs of each umbrella genre were added over time
+# The front end used to work these out in the browser on every page load, classifying every
+# genre of every song, which froze the page for seconds on big libraries. They are computed
+# once per scrape instead (see api_call.ensure_library_umbrellas) and static/js/main.js only
+# renders them. The classifiers are the ones main.js used, and the results are the same
+
+# In the order the front end uses, e.g. for ties and colors
+GENRE_LABELS = ['Pop', 'Rock', 'Rap', 'Electronic', 'Classical', 'Jazz', 'Metal', 'Other']
+# Number of equally wide bins the library's timeline is split into, by date added
+NUM_TIME_BINS = 50
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+def contains_any(genre, words):
+    return any(word in genre for word in words)
+
+# genre (lower case) -> whether it belongs to the umbrella genre; "Other" is everything else
+CLASSIFIERS = {
+    "Rock" : lambda genre: contains_any(genre, ['rock', 'punk', 'grunge', 'indie', 'garage']),
+    "Pop" : lambda genre: 'pop' in genre,
+    "Rap" : lambda genre: contains_any(genre, ['rap', 'hip hop', 'hiphop']) and
+                          not contains_any(genre, ['traprun', 'electronic trap', 'bass trap']),
+    "Electronic" : lambda genre: contains_any(genre, ['electro', 'tronica', 'house', 'techno', 'edm', 'trance',
+                                                      'dub', 'chip', 'glitch', 'jungle', 'idm', 'traprun',
+                                                      'chillstep', 'chillwave', 'bass trap']) and
+                                 not contains_any(genre, ['edmunds', 'edmonton', 'dublin']),
+    "Classical" : lambda genre: contains_any(genre, ['classical', 'baroque', 'choir']) or
+                                ('orchestra' in genre and 'jazz' not in genre),
+    "Metal" : lambda genre: contains_any(genre, ['metal', 'death', 'hardcore', 'thrash']),
+    "Jazz" : lambda genre: contains_any(genre, ['jazz', 'ragtime']),
+}
+
+# Returns the umbrella genres a genre belongs to, in GENRE_LABELS order
+def classify_genre(genre):
+    genre = genre.lower()
+    umbrellas = [label for label in GENRE_LABELS if label != "Other" and CLASSIFIERS[label](genre)]
+
+    return umbrellas if umbrellas else ["Other"]
+
+# Returns the umbrella genres with the most votes, where every entry of counts (one per
+# GENRE_LABELS) is a vote count; a tie with "Other" goes to the other umbrella genres
+# As in main.js, a song with no genres ties between every umbrella genre
+def get_top_matches(counts):
+    max_count = 0
+    top_matches = []
+    for label, count in zip(GENRE_LABELS, counts):
+        if count > max_count:
+            max_count = count
+            top_matches = [label]
+        elif count == max_count:
+            top_matches.append(label)
+
+    if len(top_matches) > 1:
+        top_matches = [label for label in top_matches if label != "Other"]
+    return top_matches
+
+def parse_date(date):
+    try:
+        added = datetime.datetime.strptime(date, DATE_FORMAT).replace(tzinfo=datetime.timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+    return int(added.timestamp() * 1000)
+
+# Returns the edges (milliseconds since the epoch) of num_bins equally wide bins from the
+# earliest to the latest time, or None if there are no times
+def get_time_bin_edges(times, num_bins=NUM_TIME_BINS):
+    times = [time for time in times if time is not None]
+    if not times:
+        return None
+
+    start, end = min(times), max(times)
+    width = max(end - start, 1) / num_bins
+    return [int(round(start + i * width)) for i in range(num_bins)] + [end]
+
+def get_time_bin(time, edges):
+    if time is None or edges is None:
+        return None
+
+    num_bins = len(edges) - 1
+    width = max(edges[-1] - edges[0], 1) / num_bins
+    return min(int((time - edges[0]) / width), num_bins - 1)
+
+# Umbrella genres of a library's songs, of every genre in genre_names, and the timeline
+# genres and dates have an entry per song (its genres, and the date it was added or None)
+# Returns a dictionary that is written next to library.json:
+#   genreLabels   GENRE_LABELS
+#   songs         lists with an entry per song, in library order (as columns, which is much
+#                 smaller than a dictionary per song): "counts" (how many of the song's genres
+#                 belong to each umbrella genre, in genreLabels order; a song "is" every umbrella
+#                 genre with a count above 0), "topUmbrellaMatches" and "timeBin" (None without
+#                 a date)
+#   genres        genre name -> its topUmbrellaMatches, for every genre in genre_names
+#   genreDates    genre -> [first, last] date a song of that genre was added to the library
+#   timeBins      "edges" of the bins (ms since the epoch, one more than there are bins) and
+#                 "topUmbrellaCounts": umbrella genre -> number of songs per bin whose first top
+#                 match it is. None for a library without dates
+def get_library_umbrellas(genres, dates, genre_names, num_bins=NUM_TIME_BINS):
+    # a library repeats the same few hundred genres many times over, so classify each once
+    umbrellas_of = {}
+    def get_umbrellas(genre):
+        umbrellas = umbrellas_of.get(genre)
+        if umbrellas is None:
+            umbrellas = umbrellas_of[genre] = classify_genre(genre)
+        return umbrellas
+
+    times = [parse_date(date) for date in dates]
+    edges = get_time_bin_edges(times, num_bins=num_bins)
+    top_umbrella_counts = { label : [0] * num_bins for label in GENRE_LABELS }
+
+    songs = { "counts" : [], "topUmbrellaMatches" : [], "timeBin" : [] }
+    genre_dates = {}
+    for song_genres, date, time in zip(genres, dates, times):
+        counts = dict.fromkeys(GENRE_LABELS, 0)
+        for genre in song_genres:
+            for umbrella in get_umbrellas(genre):
+                counts[umbrella] += 1
+
+            if time is not None:
+                first_last = genre_dates.get(genre)
+                if first_last is None:
+                    genre_dates[genre] = [date, date]
+                else:
+                    # dates in DATE_FORMAT sort the same as the times they stand for
+                    first_last[0] = min(first_last[0], date)
+                    first_last[1] = max(first_last[1], date)
+
+        counts = [counts[label] for label in GENRE_LABELS]
+        top_matches = get_top_matches(counts)
+        time_bin = get_time_bin(time, edges)
+        if time_bin is not None:
+            top_umbrella_counts[top_matches[0]][time_bin] += 1
+
+        songs["counts"].append(counts)
+        songs["topUmbrellaMatches"].append(top_matches)
+        songs["timeBin"].append(time_bin)
+
+    return {
+        "genreLabels" : GENRE_LABELS,
+        "songs" : songs,
+        # a genre only belongs to "Other" when it belongs to nothing else, so its umbrella
+        # genres are its top matches
+        "genres" : { name : get_umbrellas(name) for name in genre_names },
+        "genreDates" : genre_dates,
+        "timeBins" : { "edges" : edges, "topUmbrellaCounts" : top_umbrella_counts } if edges is not None else None,
+    }
@@ -1,7 +1,8 @@
 import numpy as np
-import math
 import spotipy
 
+import cache
+
 # Given a lsit of tracks, get their song features
 def featurize_tracks(tracks, spotipy_session, chunk_size=100, verbose=False):
     # From the features, extract just the ones we want
@@ -16,35 +17,19 @@ def featurize_tracks(tracks, spotipy_session, chunk_size=100, verbose=False):
         else:
             return [features[feature_to_get] for feature_to_get in features_to_get]
     
+    # Fetch the features we are interested in for a batch of track ids
+    def fetch_features(track_ids):
+        chunk_track_features = spotipy_session.audio_features(track_ids)
+        return [None if features is None else { feature : features[feature] for feature in features_to_get }
+                for features in chunk_track_features]
+
     # Get all of the features we are interested in from a set of track URIs
+    # Features are shared between users, so only the tracks missing from the cache are requested
     def get_features_for_songs(songs, chunk_size=100, verbose=False):
-        all_features = []
-        num_chunks = math.floor(len(songs) / chunk_size)
-        remainder = round(((len(songs) / chunk_size) % 1) * chunk_size)
-        for i in range(num_chunks):
-            low = chunk_size * i
-            high = chunk_size * (i + 1)
-            uris = songs[low:high]
-
-            chunk_track_features = spotipy_session.audio_features(uris)      
-            all_features += [extract_features(features) for features in chunk_track_features]
-            # if verbose:
-                # print(f"{((i + 1) / num_chunks)*100:.1f}% done", end="\r")
-
-        # Finish the last chunk
-        if remainder != 0:
-            try:
-                low = high
-                high = high + chunk_size
-            except:
-                low = 0
-                high = chunk_size
-            uris = songs[low:high]
-
-            chunk_track_features = spotipy_session.audio_features(uris)
-            all_features += [extract_features(features) for features in chunk_track_features]
+        track_ids = [uri.split(":")[-1] for uri in songs]
+        all_features = cache.cached_lookup(track_ids, cache.get_audio_features_cache(), fetch_features, chunk_size)
 
-        return all_features
+        return [extract_features(features) for features in all_features]
     
     def get_uris(tracks):
         uris = []
@@ -68,7 +53,7 @@ def featurize_tracks(tracks, spotipy_session, chunk_size=100, verbose=False):
     
     track_uris = get_uris(tracks)    
     
-    tracks_features = get_features_for_songs(track_uris, verbose=verbose)
+    tracks_features = get_features_for_songs(track_uris, chunk_size=chunk_size, verbose=verbose)
     
     track_names = []
     popularities = []
@@ -84,7 +69,12 @@ def featurize_tracks(tracks, spotipy_session, chunk_size=100, verbose=False):
             
     ret_features = np.array([features + [pop] for pop, features in zip(popularities, tracks_features_good)])
     
-    average_features = np.mean(ret_features, axis=0)
+    if len(ret_features) == 0:
+        # none of the tracks has features, so there is nothing to average (np.mean would give NaN)
+        ret_features = np.empty((0, len(feature_names)))
+        average_features = None
+    else:
+        average_features = np.mean(ret_features, axis=0)
     
     data = {
             "features" : ret_features,
@@ -94,64 +84,45 @@ def featurize_tracks(tracks, spotipy_session, chunk_size=100, verbose=False):
     
     return track_names, ret_uris, data
 
+# Get the genres of every artist given
+# Each distinct artist is only looked up once, and artists whose genres are already
+# in the shared cache aren't requested at all
 def get_artists_genres(artists, spotipy_session, chunk_size=50, verbose=False):
-    all_genres = []
-    num_artists = len(artists)
-    num_chunks = math.floor(num_artists / chunk_size)
-    remainder = round(((num_artists / chunk_size) % 1) * chunk_size)
-    
-    for i in range(num_chunks):
-        low = chunk_size * i
-        high = chunk_size * (i + 1)
-        uris = artists[low:high]
+    def fetch_genres(artist_ids):
+        artist_information = spotipy_session.artists(artist_ids)['artists']
+        return [None if artist is None else artist['genres'] for artist in artist_information]
 
-        artist_information = spotipy_session.artists(uris)['artists']      
-        all_genres += [artist['genres'] for artist in artist_information]
-        # if verbose:
-            # print(f"{((i + 1) / num_chunks)*100:.1f}% done", end="\r")
+    artist_ids = [str(uri).split(":")[-1] for uri in artists]
+    all_genres = cache.cached_lookup(artist_ids, cache.get_artist_genres_cache(), fetch_genres, chunk_size)
 
-    # Finish the last chunk
-    if remainder != 0:
-        try:
-            low = high
-            high = high + chunk_size
-        except:
-            low = 0
-            high = chunk_size
-        uris = artists[low:high]
-
-        artist_information = spotipy_session.artists(uris)['artists']      
-        all_genres += [artist['genres'] for artist in artist_information]
-        
-    return all_genres
+    return [genres if genres is not None else [] for genres in all_genres]
 
 
+# Get the artists and genres of every track
+# Returns three lists with an entry per track: the track's artist names, artist uris and genres
+# (the concatenation of its artists' genres)
 def get_song_genres(tracks, spotipy_session, chunk_size=50, verbose=False):
-    num_tracks = len(tracks)
-    
+    # Flatten the artists of every track into one list, recording where each track's
+    # artists start and end so they can be grouped back together in a single pass
     all_artists = []
     all_artist_names = []
-    index = []
-    for i, track in enumerate(tracks):
+    offsets = [0]
+    for track in tracks:
         artists = track['track']['artists']
         for artist in artists:
             all_artists.append(artist['uri'])
             all_artist_names.append(artist['name'])
-            index.append(i)
+        offsets.append(len(all_artists))
     
-    all_artists = np.array(all_artists)
-    all_artist_names = np.array(all_artist_names)
-    index = np.array(index)
-    all_genres = np.array(get_artists_genres(all_artists, spotipy_session, chunk_size=chunk_size, verbose=verbose))
+    all_genres = get_artists_genres(all_artists, spotipy_session, chunk_size=chunk_size, verbose=verbose)
     
     genres = []
     artist_uris = []
     artist_names = []
-    track_indices = np.arange(num_tracks)
-    for track_index in track_indices:
-        genres.append(sum(all_genres[np.where(track_index == index)], []))
-        artist_uris.append(list(all_artists[np.where(track_index == index)]))
-        artist_names.append(list(all_artist_names[np.where(track_index == index)]))
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        genres.append([genre for artist_genres in all_genres[start:end] for genre in artist_genres])
+        artist_uris.append(all_artists[start:end])
+        artist_names.append(all_artist_names[start:end])
 
     return artist_names, artist_uris, genres
 